@@ -0,0 +1,139 @@
+import argparse, csv, itertools, multiprocessing, os, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from grid import Grid
+from model import Model
+from policy import PolicyIteration, ValueIteration
+
+PARAMETERS = ["size", "obstacles", "traps", "rest", "epsilon", "deterministic", "algorithm", "synchronous", "seed"]
+RESULTS = ["iterations", "residual", "wall_time", "start_value", "error"]
+
+def parameter_grid(sizes, obstacles, traps, rest, epsilons, deterministic, algorithms, synchronous, seeds) :
+    """Returns one job dict per combination of parameters and seed"""
+    return [dict(zip(PARAMETERS, values)) for values in itertools.product(sizes, obstacles, traps, rest, epsilons, deterministic, algorithms, synchronous, seeds)]
+
+def job_key(job) :
+    return tuple(str(job[name]) for name in PARAMETERS)
+
+def solve(job) :
+    """Generates and solves the grid of one job and returns its result row"""
+    row = dict(job)
+    try :
+        start = time.perf_counter()
+        grid = Grid(job["size"], job["obstacles"], job["traps"], job["rest"], seed=job["seed"])
+        model = Model(grid, job["deterministic"], job["epsilon"])
+        if job["algorithm"] == "policy" :
+            p = PolicyIteration(grid, model, job["synchronous"])
+        elif job["algorithm"] == "value" :
+            p = ValueIteration(grid, model, job["synchronous"])
+        else :
+            raise ValueError(f"Unknown algorithm {job['algorithm']}")
+        diffs = p.derive_policy()
+        row.update(iterations=len(diffs), residual=float(diffs[-1]) if len(diffs) else 0.0, wall_time=time.perf_counter() - start,
+                   start_value=p.value_function[grid.start], error="")
+    except Exception as e :
+        row.update(iterations="", residual="", wall_time="", start_value="", error=repr(e))
+    return row
+
+started = None
+
+def track(queue) :
+    global started
+    started = queue
+
+def solve_chunk(jobs) :
+    rows = []
+    for job in jobs :
+        if started is not None :
+            started.put((job_key(job), True))
+        rows.append(solve(job))
+        if started is not None :
+            started.put((job_key(job), False))
+    return rows
+
+def completed_jobs(path) :
+    if not os.path.exists(path) :
+        return set()
+    with open(path, newline="") as f :
+        return {job_key(row) for row in csv.DictReader(f)}
+
+def run_batch(jobs, path, workers = None, chunksize = 4, retries = 2) :
+    """Solves every job over a process pool and appends each result row to a CSV file
+
+    Rows are written and flushed as soon as their chunk completes, and jobs already present
+    in the file are skipped, so an interrupted batch resumes where it stopped. If a worker
+    dies the pool is restarted for the unfinished jobs, one job per chunk; a job that was
+    running during more than retries crashes is recorded with an error instead.
+
+    Args:
+        jobs (list): Job dicts as returned by parameter_grid
+        path (str): The CSV file to append the results to
+        workers (int, optional): The number of worker processes. Defaults to the CPU count.
+        chunksize (int, optional): The number of jobs sent to a worker at once. Defaults to 4.
+        retries (int, optional): The number of crashes a job may be running in. Defaults to 2.
+    """
+    done = completed_jobs(path)
+    pending = [job for job in jobs if job_key(job) not in done]
+    chunks = [pending[i:i + chunksize] for i in range(0, len(pending), chunksize)]
+    attempts = {}
+
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, "a", newline="") as f :
+        writer = csv.DictWriter(f, fieldnames=PARAMETERS + RESULTS)
+        if new_file :
+            writer.writeheader()
+
+        def write(rows) :
+            writer.writerows(rows)
+            f.flush()
+
+        while chunks :
+            queue = multiprocessing.SimpleQueue()
+            finished = set()
+            with ProcessPoolExecutor(workers, initializer=track, initargs=(queue,)) as pool :
+                futures = [pool.submit(solve_chunk, chunk) for chunk in chunks]
+                try :
+                    for future in as_completed(futures) :
+                        rows = future.result()
+                        write(rows)
+                        finished.update(job_key(row) for row in rows)
+                except BrokenProcessPool :
+                    pass
+            running = set()
+            while not queue.empty() :
+                key, starting = queue.get()
+                (running.add if starting else running.discard)(key)
+
+            # Only the jobs that were running when the pool broke are suspected of crashing it
+            survivors = []
+            for job in [job for chunk in chunks for job in chunk if job_key(job) not in finished] :
+                if job_key(job) in running :
+                    attempts[job_key(job)] = attempts.get(job_key(job), 0) + 1
+                if attempts.get(job_key(job), 0) > retries :
+                    write([dict(job, error="worker crashed")])
+                else :
+                    survivors.append(job)
+            chunks = [[job] for job in survivors]
+
+def main(argv = None) :
+    parser = argparse.ArgumentParser(description="Solve many generated grids in parallel and store the results as CSV")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10])
+    parser.add_argument("--obstacles", type=float, nargs="+", default=[0.5])
+    parser.add_argument("--traps", type=float, nargs="+", default=[0.1])
+    parser.add_argument("--rest", type=float, nargs="+", default=[0.05])
+    parser.add_argument("--epsilons", type=float, nargs="+", default=[0.4])
+    parser.add_argument("--models", choices=["deterministic", "stochastic"], nargs="+", default=["stochastic"])
+    parser.add_argument("--algorithms", choices=["policy", "value"], nargs="+", default=["policy", "value"])
+    parser.add_argument("--modes", choices=["sync", "async"], nargs="+", default=["sync"])
+    parser.add_argument("--seeds", type=int, default=10, help="Number of seeds per combination")
+    parser.add_argument("--output", default="results.csv")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    jobs = parameter_grid(args.sizes, args.obstacles, args.traps, args.rest, args.epsilons, [m == "deterministic" for m in args.models],
+                          args.algorithms, [m == "sync" for m in args.modes], range(args.seeds))
+    run_batch(jobs, args.output, args.workers, args.chunksize)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,112 @@
+import argparse, json, os, sys, time, tracemalloc
+import numpy as np
+from grid import Grid
+from model import Model
+from policy import PolicyIteration, ValueIteration
+from bounds import BoundedValueIteration
+
+ALGORITHMS = {"policy" : PolicyIteration, "value" : ValueIteration}
+
+def measure(setup, function, repeat = 3) :
+    """Times function(setup()) and then runs it once more under tracemalloc for the peak memory
+
+    The best of repeat timed runs is kept, and tracing runs separately because it slows
+    allocations down noticeably. Returns the subject and result of the last timed run,
+    the wall time and the peak in bytes.
+    """
+    elapsed = float("inf")
+    for _ in range(repeat) :
+        subject = setup()
+        start = time.perf_counter()
+        result = function(subject)
+        elapsed = min(elapsed, time.perf_counter() - start)
+
+    other = setup()
+    tracemalloc.start()
+    function(other)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return subject, result, elapsed, peak
+
+def run(sizes, seed = 0, obstacles = 0.3, traps = 0.1, rest = 0.05, repeat = 3) :
+    """Times grid construction, model construction and every solver variant on each size
+
+    Returns a dict mapping benchmark names like "20/value/sync/stochastic" to their metrics.
+    The parallel engine entries also hold the worker count and their speedup over the
+    NumPy engine, and the asynchronous NumPy and bounded entries the number of moves
+    they evaluated, both bounds of a move counting for the bounded one.
+    """
+    results = {}
+    for size in sizes :
+        _, grid, elapsed, peak = measure(lambda : None, lambda _ : Grid(size, obstacles, traps, rest, seed=seed), repeat)
+        results[f"{size}/grid"] = {"time" : elapsed, "peak_memory" : peak}
+        for deterministic in [True, False] :
+            kind = "deterministic" if deterministic else "stochastic"
+            _, model, elapsed, peak = measure(lambda : None, lambda _ : Model(grid, deterministic), repeat)
+            results[f"{size}/model/{kind}"] = {"time" : elapsed, "peak_memory" : peak}
+            for name, algorithm in ALGORITHMS.items() :
+                for synchronous in [True, False] :
+                    p, diffs, elapsed, peak = measure(lambda : algorithm(grid, model, synchronous), lambda p : p.derive_policy(), repeat)
+                    results[f"{size}/{name}/{'sync' if synchronous else 'async'}/{kind}"] = {
+                        "time" : elapsed,
+                        "peak_memory" : peak,
+                        "sweeps" : len(diffs),
+                        "backups" : p.backups,
+                        "backups_per_second" : p.backups / elapsed if elapsed else 0.0,
+                    }
+            # Synchronous array sweeps in one process and split over one worker per CPU
+            for engine in ["numpy", "parallel"] :
+                p, diffs, elapsed, peak = measure(lambda : ValueIteration(grid, model, True, engine=engine), lambda p : p.derive_policy(), repeat)
+                results[f"{size}/value/sync/{kind}/{engine}"] = {"time" : elapsed, "peak_memory" : peak, "sweeps" : len(diffs), "backups" : p.backups}
+            parallel = results[f"{size}/value/sync/{kind}/parallel"]
+            parallel["workers"] = os.cpu_count()
+            parallel["speedup"] = results[f"{size}/value/sync/{kind}/numpy"]["time"] / parallel["time"] if parallel["time"] else 0.0
+            # Asynchronous NumPy sweeps against the bounds, counting every move backed up
+            p, diffs, elapsed, peak = measure(lambda : ValueIteration(grid, model, engine="numpy"), lambda p : p.derive_policy(), repeat)
+            results[f"{size}/value/async/{kind}/numpy"] = {"time" : elapsed, "peak_memory" : peak, "sweeps" : len(diffs), "backups" : p.backups,
+                                                           "evaluations" : len(diffs) * int(np.count_nonzero(p.engine.valid))}
+            p, diffs, elapsed, peak = measure(lambda : BoundedValueIteration(grid, model), lambda p : p.derive_policy(), repeat)
+            results[f"{size}/bounded/async/{kind}"] = {"time" : elapsed, "peak_memory" : peak, "sweeps" : len(diffs), "backups" : p.backups,
+                                                       "evaluations" : p.evaluations}
+    return results
+
+def compare(results, baseline, threshold) :
+    """Returns the benchmarks whose time grew by more than threshold relative to the baseline"""
+    regressions = {}
+    for name, metrics in results.items() :
+        if name in baseline and baseline[name]["time"] > 0 :
+            ratio = metrics["time"] / baseline[name]["time"]
+            if ratio > 1 + threshold :
+                regressions[name] = ratio
+    return regressions
+
+def main(argv = None) :
+    parser = argparse.ArgumentParser(description="Benchmark grid generation, model construction and the solvers")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 20, 40])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark, the fastest is kept")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", default=None, help="JSON file of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed relative slowdown before a regression is reported")
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.seed, repeat=args.repeat)
+    with open(args.output, "w") as f :
+        json.dump(results, f, indent=2)
+    for name, metrics in results.items() :
+        if "speedup" in metrics :
+            extra = f"{metrics['speedup']:.2f}x on {metrics['workers']} workers"
+        else :
+            extra = f"{metrics['evaluations']} evaluations" if "evaluations" in metrics else ""
+        print(f"{name:<40} {metrics['time'] * 1000:>10.1f} ms {metrics['peak_memory'] / 2 ** 20:>8.2f} MiB {metrics.get('sweeps', ''):>6} {extra}")
+
+    if args.baseline :
+        with open(args.baseline) as f :
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, ratio in regressions.items() :
+            print(f"Regression: {name} is {ratio:.2f}x slower than the baseline")
+        if regressions :
+            sys.exit(1)
+
+if __name__ == "__main__" :
+    main()
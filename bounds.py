@@ -0,0 +1,151 @@
+import numpy as np
+from cell import Obstacle, End
+from policy import ValueIteration, ShortestPathSolver
+
+class BoundedValueIteration(ValueIteration) :
+    def __init__(self, grid, model, synchronous = False) -> None :
+        """Value iteration on an upper and a lower bound of the values, with action elimination
+
+        The lower bound starts from following a breadth-first tree towards the End and the
+        upper bound from the best path of a relaxed model, where every move may land on any
+        neighbor, so both start on the right side of the optimal values. Backups keep them
+        there and move them closer. A move whose upper bound falls below the lower bound of its
+        state can never be optimal, so it is dropped from every later backup. A state is
+        proven once its greedy move under the lower bound beats the upper bound of every
+        move left, and the run stops when all states are proven. The residual of an epoch
+        is the L2 gap between the bounds. The value function is the lower bound and the
+        policy takes the proven moves.
+
+        Args:
+            synchronous (boolean, optional): Whether sweeps back up every state from the previous
+                bounds, instead of the distance layers from the End outward in place. Defaults to False.
+        """
+        super().__init__(grid, model, synchronous, engine="numpy")
+        engine = self.engine
+        if not self.applicable(model) or not np.allclose(engine.weights[engine.valid], 1) :
+            raise ValueError("Bounds require non-positive rewards and unit transition weights")
+        self.evaluations = 0
+        self.reset_bounds()
+
+    def reset_bounds(self) :
+        """Starts both bounds, the groups of rows and the proven moves over on the current engine"""
+        engine = self.engine
+        self.lower = engine.values
+        self.upper = engine.values.copy()
+        self.initial_bounds()
+
+        # The state rows backed up together, with their remaining moves as flat edge arrays
+        reachable = np.isfinite(self.lower[engine.states])
+        groups = [np.arange(len(engine.states))] if self.synchronous else engine.layers
+        self.groups = [self.edges(rows[reachable[rows]]) for rows in groups]
+        self.choice = np.full(len(engine.states), -1, dtype=np.int64)
+        self.choice[~reachable] = 0
+        self.proven = not np.any(self.choice < 0)
+
+    @staticmethod
+    def applicable(model) :
+        grid = model.grid
+        active = ~np.isin(grid.types, [Obstacle.kind, End.kind])
+        return bool(np.all(grid.reward_mean[active] <= 0))
+
+    def initial_bounds(self) :
+        """Fills both bounds, with minus infinity for the states that cannot reach the End
+
+        The lower bound backs up the distance layers in order from the End, like the
+        asynchronous NumPy engine starts. The upper bound lets every move land on whichever
+        neighbor is best, which no policy of the real model can beat, so it is 100 minus the
+        shortest path with costs -reward. On a deterministic model it is already exact.
+        """
+        engine = self.engine
+        if self.synchronous :
+            engine.start_below()
+        distances = np.array(ShortestPathSolver.distances(self.grid))[engine.states]
+        self.upper[:] = -np.inf
+        self.upper[engine.states] = np.where(np.isfinite(self.lower[engine.states]), 100 - distances, -np.inf)
+        self.upper[engine.terminal] = 100
+
+    def sync_states(self, cells) :
+        """Matches the engine to the edited grid and restarts the bounds from scratch
+
+        Edits can lower the optimal values anywhere upstream of them, so the previous lower
+        bound is no bound any more and both bounds start over.
+        """
+        super().sync_states(cells)
+        if not self.synchronous :
+            self.engine.start_below()
+        self.reset_bounds()
+
+    def edges(self, rows) :
+        """Returns the rows and the flat arrays of their valid moves, grouped by row"""
+        engine = self.engine
+        local, slots = np.nonzero(engine.valid[rows])
+        return [rows, local, slots, engine.successors[rows[local], slots], engine.weights[rows[local], slots]]
+
+    def bounded_backup(self, group) :
+        """Backs up both bounds of a group of rows in place, dropping the moves that cannot be optimal
+
+        Returns:
+            float: The sum of the squared gaps between the new bounds
+        """
+        engine = self.engine
+        rows, local, slots, successors, weights = group
+        if not len(rows) :
+            return 0.0
+        starts = np.searchsorted(local, np.arange(len(rows)))
+        rewards = engine.rewards[rows[local]]
+        upper = np.round(rewards + weights * self.upper[successors], 3)
+        lower = np.round(rewards + weights * self.lower[successors], 3)
+        self.evaluations += 2 * len(local)
+        new_upper = np.maximum.reduceat(upper, starts)
+        new_lower = np.maximum.reduceat(lower, starts)
+        states = engine.states[rows]
+        self.upper[states] = new_upper
+        self.lower[states] = new_lower
+
+        # The greedy move under the lower bound is proven once every other move left is bounded by it
+        unknown = self.choice[rows] < 0
+        if unknown.any() :
+            greedy = np.flatnonzero(lower == new_lower[local])
+            greedy = greedy[np.unique(local[greedy], return_index=True)[1]]
+            rivals = (upper > new_lower[local]) & (np.arange(len(local)) != greedy[local])
+            proven = unknown & (np.bincount(local, weights=rivals, minlength=len(rows)) == 0)
+            self.choice[rows[proven]] = slots[greedy[proven]]
+
+        keep = upper >= new_lower[local]
+        if not keep.all() :
+            group[1:] = [array[keep] for array in group[1:]]
+        return float(np.sum((new_upper - new_lower) ** 2))
+
+    def sweep(self) :
+        total = sum(self.bounded_backup(group) for group in self.groups)
+        self.backups += sum(len(group[0]) for group in self.groups)
+        self.proven = not np.any(self.choice < 0)
+        self.emit("bounds", moves=sum(len(group[1]) for group in self.groups), evaluations=self.evaluations,
+                  proven=int(np.count_nonzero(self.choice >= 0)))
+        return float(np.sqrt(total))
+
+    def settled(self, diff) :
+        return self.proven or diff == 0
+
+    def alternating(self, diffs) :
+        return False
+
+    def policy_improvement(self) :
+        """Writes the lower bound into the value function and the proven moves into the policy"""
+        engine = self.engine
+        self.value_function = engine.value_function()
+        self.policy_changes = 0
+        for row, state in enumerate(engine.coordinates) :
+            if not np.isfinite(self.lower[engine.states[row]]) :
+                continue
+            slot = self.choice[row]
+            if slot < 0 :
+                # Not proven yet when the epochs ran out, the greedy move under the lower bound stands in
+                moves = np.where(engine.valid[row], engine.weights[row] * self.lower[engine.successors[row]], -np.inf)
+                slot = int(np.argmax(moves))
+            target = self.model.coordinates(engine.successors[row, slot])
+            new = {neighbor : int(neighbor == target) for neighbor in self.policy[state]}
+            if new != self.policy[state] :
+                self.policy_changes += 1
+            self.policy[state] = new
+        self.policy_changed = self.policy_changes > 0
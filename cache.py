@@ -0,0 +1,121 @@
+import hashlib, json, os, shutil, tempfile, time
+import numpy as np
+from grid import Grid
+from model import Model
+from cell import OFFSETS
+from policy import PolicyIteration, ValueIteration, ShortestPathSolver
+
+ALGORITHMS = {"policy" : PolicyIteration, "value" : ValueIteration, "shortest" : ShortestPathSolver}
+# Compact models are solved on the array engines with compact policies, their dict views are far slower to sweep
+OPTIONS = {"policy" : {"evaluation" : "exact", "compact_policy" : True}, "value" : {"engine" : "numpy", "compact_policy" : True}, "shortest" : {}}
+VERSION = 3
+
+class CachedSolution :
+    def __init__(self, grid, model, values, actions, diffs, meta) :
+        """A solved configuration read back from the cache
+
+        The arrays are memory mapped, so opening a solution costs almost nothing until its
+        values are used. values holds the value of every cell indexed [y, x] with NaN where
+        there is no state, and actions the DIRECTIONS slot of the policy or -1.
+        """
+        self.grid = grid
+        self.model = model
+        self.values = values
+        self.actions = actions
+        self.diffs = diffs
+        self.meta = meta
+
+    def value_function(self) :
+        """Builds the value function dict in the order used by the solvers"""
+        xs, ys = np.nonzero(~np.isnan(self.values.T))
+        result = dict(zip(zip(xs.tolist(), ys.tolist()), self.values[ys, xs].tolist()))
+        result[self.grid.end] = result.pop(self.grid.end, 100)
+        return result
+
+    def policy(self) :
+        """Builds the deterministic policy dict, one probability per accessible neighbor"""
+        result = {}
+        for (x, y) in self.value_function() :
+            if (x, y) == self.grid.end :
+                continue
+            action = self.actions[y, x]
+            chosen = (x + OFFSETS[action][0], y + OFFSETS[action][1]) if action >= 0 else None
+            result[(x, y)] = {neighbor : int(neighbor == chosen) for neighbor in self.grid.neighbor_coordinates(x, y)}
+        return result
+
+class SolutionCache :
+    def __init__(self, directory) :
+        """Content-addressed store of generated grids, compact models and their solutions
+
+        Every configuration lives in its own directory named by the hash of its parameters,
+        holding one .npy file per array and a meta.json. Entries are written to a temporary
+        directory first and renamed into place, so a reader never sees a partial entry.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def parameters(size, obstacles, traps, rest, seed, epsilon, deterministic, algorithm) :
+        if seed is None :
+            raise ValueError("Only seeded configurations can be cached")
+        if algorithm not in ALGORITHMS :
+            raise ValueError(f"Unknown algorithm {algorithm}")
+        return {"version" : VERSION, "size" : int(size), "obstacles" : float(obstacles), "traps" : float(traps), "rest" : float(rest),
+                "seed" : int(seed), "epsilon" : float(epsilon), "deterministic" : bool(deterministic), "algorithm" : algorithm}
+
+    def key(self, **parameters) :
+        encoded = json.dumps(self.parameters(**parameters), sort_keys=True).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def path(self, **parameters) :
+        return os.path.join(self.directory, self.key(**parameters))
+
+    def store(self, p, diffs, parameters, wall_time = 0.0) :
+        """Writes the grid, model and solved policy of an algorithm under its parameters"""
+        grid, model = p.grid, p.model
+        target = self.path(**parameters)
+        values, actions = p.solution_arrays()
+
+        arrays = grid.to_arrays() | model.to_arrays() | {"values" : values, "actions" : actions, "diffs" : np.asarray(diffs, dtype=float)}
+        temporary = tempfile.mkdtemp(dir=self.directory)
+        try :
+            for name, array in arrays.items() :
+                np.save(os.path.join(temporary, name + ".npy"), np.ascontiguousarray(array), allow_pickle=False)
+            with open(os.path.join(temporary, "meta.json"), "w") as f :
+                json.dump(self.parameters(**parameters) | {"wall_time" : wall_time, "arrays" : list(arrays)}, f)
+            os.rename(temporary, target)
+        except OSError :
+            # Another process stored the same configuration first
+            if not os.path.isdir(target) :
+                raise
+        finally :
+            shutil.rmtree(temporary, ignore_errors=True)
+        return target
+
+    def load(self, **parameters) :
+        """Returns the CachedSolution of a configuration, or None when it was never stored"""
+        target = self.path(**parameters)
+        meta_path = os.path.join(target, "meta.json")
+        if not os.path.exists(meta_path) :
+            return None
+        with open(meta_path) as f :
+            meta = json.load(f)
+        # Copy-on-write mappings, so the grid can still be edited without touching the cache
+        arrays = {name : np.load(os.path.join(target, name + ".npy"), mmap_mode="c", allow_pickle=False) for name in meta["arrays"]}
+        grid = Grid.from_arrays(arrays, meta["obstacles"], meta["traps"], meta["rest"], meta["seed"])
+        model = Model.from_arrays(grid, meta["deterministic"], meta["epsilon"], arrays)
+        return CachedSolution(grid, model, arrays["values"], arrays["actions"], arrays["diffs"], meta)
+
+    def solve(self, size, obstacles = 0.5, traps = 0.1, rest = 0.05, seed = 0, epsilon = 0.4, deterministic = False, algorithm = "value") :
+        """Loads a configuration from the cache, generating, solving and storing it on a miss"""
+        parameters = dict(size=size, obstacles=obstacles, traps=traps, rest=rest, seed=seed, epsilon=epsilon, deterministic=deterministic, algorithm=algorithm)
+        solution = self.load(**parameters)
+        if solution is not None :
+            return solution
+        start = time.perf_counter()
+        grid = Grid(size, obstacles, traps, rest, seed=seed)
+        model = Model(grid, deterministic, epsilon, compact=True)
+        p = ALGORITHMS[algorithm](grid, model, **OPTIONS[algorithm])
+        diffs = p.derive_policy()
+        self.store(p, diffs, parameters, time.perf_counter() - start)
+        return self.load(**parameters)
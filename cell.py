@@ -1,17 +1,36 @@
 import random
 
+DIRECTIONS = ("left", "up", "right", "down")
+OFFSETS = ((-1, 0), (0, -1), (1, 0), (0, 1))
+# The (direction, dx, dy) triples encoded by each neighbor bitmask
+NEIGHBOR_TABLE = [[(d, dx, dy) for k, (d, (dx, dy)) in enumerate(zip(DIRECTIONS, OFFSETS)) if mask >> k & 1] for mask in range(16)]
+
 class Cell :
+    __slots__ = ("reward_mean", "reward_std", "neighbors", "deterministic")
+    kind = 0
+
     def __init__(self, reward_mean = -1, reward_std = 1, deterministic = True) :
         self.reward_mean = reward_mean
-        self.reward_std = reward_std 
+        self.reward_std = reward_std
         self.neighbors = {}
         self.deterministic = deterministic
-    
+
+    @classmethod
+    def view(cls, grid, x, y) :
+        """Builds a lightweight copy of the cell stored at (x, y) in the arrays of a grid"""
+        cell = cls.__new__(cls)
+        mean = float(grid.reward_mean[y, x])
+        cell.reward_mean = "X" if mean != mean else mean
+        cell.reward_std = float(grid.reward_std[y, x])
+        cell.deterministic = bool(grid.deterministic[y, x])
+        cell.neighbors = {direction : (x + dx, y + dy) for direction, dx, dy in NEIGHBOR_TABLE[grid.neighbor_mask[y, x]]}
+        return cell
+
     def get_reward(self) :
         if self.deterministic :
             return self.reward_mean
         return random.gauss(self.reward_mean, self.reward_std)
-    
+
     def __repr__(self) :
         if type(self) == Cell :
             return "[ ]"
@@ -27,28 +46,54 @@ class Cell :
             return "[*]"
 
 class Obstacle(Cell) :
+    __slots__ = ()
+    kind = 1
+
     def __init__(self) :
         super().__init__("X")
 
 class Portal(Cell) :
+    __slots__ = ("towards",)
+    kind = 2
+
     def __init__(self, towards):
         if type(towards) != tuple :
             raise TypeError("Portal needs endpoint tuple")
         super().__init__()
         self.towards = towards
 
+    @classmethod
+    def view(cls, grid, x, y) :
+        cell = super().view(grid, x, y)
+        cell.towards = grid.portals[(x, y)]
+        return cell
+
 class Trap(Cell) :
+    __slots__ = ()
+    kind = 3
+
     def __init__(self) :
         super().__init__(-10)
 
 class Start(Cell) :
+    __slots__ = ()
+    kind = 4
+
     def __init__(self):
         super().__init__(reward_mean=-1)
 
 class End(Cell) :
+    __slots__ = ()
+    kind = 5
+
     def __init__(self):
         super().__init__(reward_mean=10000)
 
 class RestArea(Cell) :
+    __slots__ = ()
+    kind = 6
+
     def __init__(self):
-        super().__init__(reward_mean=-0.5)
\ No newline at end of file
+        super().__init__(reward_mean=-0.5)
+
+CELL_TYPES = (Cell, Obstacle, Portal, Trap, Start, End, RestArea)
@@ -0,0 +1,100 @@
+import argparse, json, math, sys, time
+import numpy as np
+from cell import DIRECTIONS
+from grid import Grid
+from model import Model
+from policy import PolicyIteration, ValueIteration, ShortestPathSolver
+
+def algorithm_class(name) :
+    """Returns the solver class of an algorithm name, importing the optional modules on demand"""
+    if name == "bounded" :
+        from bounds import BoundedValueIteration
+        return BoundedValueIteration
+    return {"policy" : PolicyIteration, "value" : ValueIteration, "shortest" : ShortestPathSolver}[name]
+
+def solution_json(p, diffs, wall_time) :
+    """Returns the solution as a JSON-ready dict, with rows indexed [y][x] and null where there is no state"""
+    values, actions = p.solution_arrays()
+    return {
+        "size" : p.grid.size,
+        "seed" : p.grid.seed,
+        "algorithm" : type(p).__name__,
+        "epochs" : len(diffs),
+        "converged" : p.converged,
+        "residual" : float(diffs[-1]) if len(diffs) else None,
+        "wall_time" : wall_time,
+        "start_value" : p.value_function[p.grid.start] if math.isfinite(p.value_function[p.grid.start]) else None,
+        "values" : [[value if math.isfinite(value) else None for value in row] for row in values.tolist()],
+        "policy" : [[DIRECTIONS[action] if action >= 0 else None for action in row] for row in actions.tolist()],
+    }
+
+def plot_convergence(diffs, path) :
+    """Saves the residuals of a run as a scatter plot, without a display"""
+    from matplotlib.figure import Figure
+    figure = Figure(figsize=(6, 4))
+    axes = figure.add_subplot()
+    axes.scatter(range(len(diffs)), diffs, s=8)
+    axes.set_title("Convergence Analysis of Policy Algorithm")
+    axes.set_xlabel("Iteration")
+    axes.set_ylabel("Diff")
+    figure.savefig(path)
+
+def main(argv = None) :
+    parser = argparse.ArgumentParser(description="Generate and solve a grid without the GUI, writing the values and policy")
+    parser.add_argument("--size", type=int, default=15)
+    parser.add_argument("--obstacles", type=int, default=50, help="Obstacle %%")
+    parser.add_argument("--traps", type=int, default=10, help="Trap %%")
+    parser.add_argument("--rest", type=int, default=2, help="Neutral zone %%")
+    parser.add_argument("--stochastic", action="store_true", help="Stochastic transitions")
+    parser.add_argument("--epsilon", type=float, default=0.4, help="Misfire probability of stochastic transitions")
+    parser.add_argument("--asynchronous", action="store_true")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--algorithm", choices=["policy", "value", "shortest", "bounded"], default="value")
+    parser.add_argument("--compact", action="store_true", help="Store the model as flat arrays")
+    parser.add_argument("--format", choices=["json", "npz"], default="json")
+    parser.add_argument("--output", default=None, help="Output file, standard output for JSON when omitted")
+    parser.add_argument("--plot", default=None, metavar="PATH", help="Save the convergence plot to PATH")
+    parser.add_argument("--gui", action="store_true", help="Open the Tk visualizer instead")
+    parser.add_argument("--verbose", action="store_true", help="Print the solver messages to standard error")
+    args = parser.parse_args(argv)
+
+    if args.gui :
+        from main import Visualizer
+        Visualizer().mainloop()
+        return
+    if args.obstacles + args.traps + args.rest > 100 :
+        parser.error("Obstacles, traps and neutral zones exceed 100%")
+    if args.format == "npz" and args.output is None :
+        parser.error("Binary output needs --output")
+
+    start = time.perf_counter()
+    grid = Grid(args.size, args.obstacles / 100, args.traps / 100, args.rest / 100, seed=args.seed)
+    model = Model(grid, not args.stochastic, args.epsilon, compact=args.compact)
+    solver = algorithm_class(args.algorithm)
+    options = {} if args.algorithm == "shortest" else {"synchronous" : not args.asynchronous}
+    if args.algorithm in ("policy", "value") :
+        options["compact_policy"] = True
+    try :
+        p = solver(grid, model, **options)
+    except ValueError as e :
+        parser.error(str(e))
+    if args.verbose :
+        p.add_observer(lambda event : "message" in event and print(event["message"], file=sys.stderr))
+    diffs = p.derive_policy()
+    wall_time = time.perf_counter() - start
+
+    if args.format == "npz" :
+        values, actions = p.solution_arrays()
+        np.savez(args.output, values=values, actions=actions, types=grid.types, diffs=np.asarray(diffs, dtype=float))
+    else :
+        text = json.dumps(solution_json(p, diffs, wall_time))
+        if args.output is None :
+            print(text)
+        else :
+            with open(args.output, "w") as f :
+                f.write(text)
+    if args.plot :
+        plot_convergence(diffs, args.plot)
+
+if __name__ == "__main__" :
+    main()
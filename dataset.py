@@ -0,0 +1,223 @@
+import argparse, collections, json, os, sys, time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from grid import Grid
+from model import Model
+from cache import ALGORITHMS, OPTIONS
+
+MANIFEST = "manifest.json"
+VERSION = 1
+
+def record_dtype(size) :
+    """Returns the fixed-size record of one solved grid, with every array indexed [y, x]
+
+    types holds the cell kinds, values the value of every cell with NaN where there is no
+    state, and actions the DIRECTIONS slot of the policy or -1.
+    """
+    return np.dtype([("seed", "<i8"), ("epochs", "<i4"), ("types", "u1", (size, size)),
+                     ("values", "<f4", (size, size)), ("actions", "i1", (size, size))])
+
+def solve_sample(parameters, seed) :
+    """Generates and solves the grid of one seed and returns it as a record"""
+    grid = Grid(parameters["size"], parameters["obstacles"], parameters["traps"], parameters["rest"], seed=seed)
+    model = Model(grid, parameters["deterministic"], parameters["epsilon"], compact=True)
+    algorithm = parameters["algorithm"]
+    p = ALGORITHMS[algorithm](grid, model, **OPTIONS[algorithm])
+    diffs = p.derive_policy()
+    values, actions = p.solution_arrays()
+    record = np.zeros((), dtype=record_dtype(grid.size))
+    record["seed"], record["epochs"] = seed, len(diffs)
+    record["types"], record["values"], record["actions"] = grid.types, values, actions
+    return record
+
+def solve_chunk(parameters, seeds) :
+    return [solve_sample(parameters, seed) for seed in seeds]
+
+def samples(parameters, seeds, workers = None, chunksize = 8, prefetch = 2) :
+    """Yields the records of the seeds in order, solving them lazily over a process pool
+
+    At most workers * prefetch chunks are pending at once, so memory stays bounded however
+    many seeds there are, and the seeds are only consumed as the records are taken.
+
+    Args:
+        parameters (dict): The grid, model and algorithm parameters shared by every sample
+        seeds (iterable): The seeds to generate, in the order of the records
+        workers (int, optional): The number of worker processes. Defaults to the CPU count.
+        chunksize (int, optional): The number of seeds sent to a worker at once. Defaults to 8.
+        prefetch (int, optional): The number of chunks pending per worker. Defaults to 2.
+    """
+    seeds = iter(seeds)
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as pool :
+        pending = collections.deque()
+        limit = workers * prefetch
+
+        def submit() :
+            chunk = [seed for _, seed in zip(range(chunksize), seeds)]
+            if chunk :
+                pending.append(pool.submit(solve_chunk, parameters, chunk))
+            return bool(chunk)
+
+        while len(pending) < limit and submit() :
+            pass
+        while pending :
+            records = pending.popleft().result()
+            submit()
+            yield from records
+
+class ShardWriter :
+    def __init__(self, directory, parameters, shard_records = 4096, sync = 256) :
+        """Appends records to numbered binary shards and keeps a manifest of the complete ones
+
+        Every shard is a raw file of fixed-size records, closed once it holds shard_records
+        of them. The manifest lists the records of every shard and is replaced atomically
+        after the shards are flushed to disk, every sync records and at every new shard, so
+        it never counts a record that is not on disk. Opening an existing dataset cuts the
+        last shard back to the manifest and appends after it, which resumes an interrupted run.
+
+        Args:
+            directory (str): The dataset directory, created if missing
+            parameters (dict): The parameters of the samples, which must match an existing dataset
+            shard_records (int, optional): The number of records per shard. Defaults to 4096.
+            sync (int, optional): The number of records between manifest updates. Defaults to 256.
+        """
+        self.directory = directory
+        self.sync = sync
+        self.dtype = record_dtype(parameters["size"])
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, MANIFEST)
+        if os.path.exists(path) :
+            with open(path) as f :
+                self.manifest = json.load(f)
+            if self.manifest["parameters"] != parameters :
+                raise ValueError(f"{directory} holds a dataset of other parameters")
+        else :
+            self.manifest = {"version" : VERSION, "parameters" : parameters, "dtype" : np.lib.format.dtype_to_descr(self.dtype),
+                             "record_size" : self.dtype.itemsize, "shard_records" : shard_records, "records" : 0, "shards" : []}
+        self.shard_records = self.manifest["shard_records"]
+        self.unsynced = 0
+        self.file = None
+        if self.manifest["shards"] and self.manifest["shards"][-1]["records"] < self.shard_records :
+            shard = self.manifest["shards"][-1]
+            self.file = open(os.path.join(directory, shard["file"]), "r+b")
+            self.file.truncate(shard["records"] * self.dtype.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        self.write_manifest()
+
+    @property
+    def records(self) :
+        return self.manifest["records"]
+
+    def append(self, record) :
+        if self.file is None :
+            name = f"shard-{len(self.manifest['shards']):05d}.bin"
+            self.manifest["shards"].append({"file" : name, "records" : 0})
+            self.file = open(os.path.join(self.directory, name), "wb")
+        self.file.write(np.asarray(record, dtype=self.dtype).tobytes())
+        self.manifest["shards"][-1]["records"] += 1
+        self.manifest["records"] += 1
+        self.unsynced += 1
+        if self.manifest["shards"][-1]["records"] == self.shard_records :
+            self.flush()
+            self.file.close()
+            self.file = None
+        elif self.unsynced >= self.sync :
+            self.flush()
+
+    def flush(self) :
+        """Makes the appended records durable and counts them in the manifest"""
+        if self.file is not None :
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.write_manifest()
+        self.unsynced = 0
+
+    def write_manifest(self) :
+        path = os.path.join(self.directory, MANIFEST)
+        with open(path + ".tmp", "w") as f :
+            json.dump(self.manifest, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def close(self) :
+        self.flush()
+        if self.file is not None :
+            self.file.close()
+            self.file = None
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *exc_info) :
+        self.close()
+
+class Dataset :
+    def __init__(self, directory) :
+        """Read-only view of a dataset written by ShardWriter, memory mapping every shard
+
+        Records are numbered across the shards in the order they were written, and indexing
+        returns a structured record whose fields map the shard without copying it.
+        """
+        with open(os.path.join(directory, MANIFEST)) as f :
+            self.manifest = json.load(f)
+        self.parameters = self.manifest["parameters"]
+        self.dtype = np.lib.format.descr_to_dtype(self.manifest["dtype"])
+        self.shards = [np.memmap(os.path.join(directory, shard["file"]), self.dtype, mode="r", shape=(shard["records"],))
+                       for shard in self.manifest["shards"] if shard["records"]]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+
+    def __len__(self) :
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index) :
+        if index < 0 :
+            index += len(self)
+        if not 0 <= index < len(self) :
+            raise IndexError("Record index out of range")
+        shard = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        return self.shards[shard][index - self.offsets[shard]]
+
+    def __iter__(self) :
+        for shard in self.shards :
+            yield from shard
+
+def generate(directory, parameters, count, first_seed = 0, workers = None, chunksize = 8, shard_records = 4096) :
+    """Solves the grids of seeds first_seed onwards until the dataset holds count records
+
+    Record i always comes from seed first_seed + i, so a run that was interrupted picks
+    up at the first seed missing from the manifest.
+    """
+    parameters = parameters | {"first_seed" : first_seed}
+    with ShardWriter(directory, parameters, shard_records) as writer :
+        seeds = range(first_seed + writer.records, first_seed + count)
+        for record in samples(parameters, seeds, workers, chunksize) :
+            writer.append(record)
+        return writer.records
+
+def main(argv = None) :
+    parser = argparse.ArgumentParser(description="Generate and solve many seeded grids into sharded binary files with a manifest")
+    parser.add_argument("output", help="Dataset directory")
+    parser.add_argument("--count", type=int, default=1000, help="Number of solved grids")
+    parser.add_argument("--first-seed", type=int, default=0)
+    parser.add_argument("--size", type=int, default=15)
+    parser.add_argument("--obstacles", type=float, default=0.5)
+    parser.add_argument("--traps", type=float, default=0.1)
+    parser.add_argument("--rest", type=float, default=0.05)
+    parser.add_argument("--epsilon", type=float, default=0.4)
+    parser.add_argument("--stochastic", action="store_true", help="Stochastic transitions")
+    parser.add_argument("--algorithm", choices=list(ALGORITHMS), default="value")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunksize", type=int, default=8)
+    parser.add_argument("--shard-records", type=int, default=4096)
+    args = parser.parse_args(argv)
+
+    parameters = {"size" : args.size, "obstacles" : args.obstacles, "traps" : args.traps, "rest" : args.rest,
+                  "epsilon" : args.epsilon, "deterministic" : not args.stochastic, "algorithm" : args.algorithm}
+    start = time.perf_counter()
+    try :
+        records = generate(args.output, parameters, args.count, args.first_seed, args.workers, args.chunksize, args.shard_records)
+    except ValueError as e :
+        parser.error(str(e))
+    print(f"{records} records in {args.output} ({time.perf_counter() - start:.1f}s)", file=sys.stderr)
+
+if __name__ == "__main__" :
+    main()
@@ -0,0 +1,276 @@
+import warnings
+import numpy as np
+from cell import Obstacle, End, DIRECTIONS, OFFSETS
+
+def ranges(starts, lengths) :
+    """Returns the concatenation of the index ranges starts[i] to starts[i] + lengths[i]"""
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+class ArrayEngine :
+    def __init__(self, model) :
+        """Array-backed Bellman backups over the states of a model
+
+        States are indexed by their flat position y * size + x, and every active state
+        (neither an Obstacle nor the End) has four action slots ordered like DIRECTIONS.
+        Missing slots point to an extra padding entry at the end of the value vector.
+
+        Args:
+            model (Model): The model of the environment to back up
+        """
+        self.model = model
+        self.grid = model.grid
+        self.size = self.grid.size
+        self.padding = self.size ** 2
+        self.terminal = self.index(self.grid.end)
+        self.portals = (self.index((self.size - 1, 0)), self.index((0, self.size - 1)))
+        self.values = np.zeros(self.padding + 1)
+
+        # Active states are ordered column by column like the keys of the value function dicts
+        active = ~np.isin(self.grid.types.T, [Obstacle.kind, End.kind])
+        xs, ys = np.nonzero(active)
+        self.coordinates = list(zip(xs.tolist(), ys.tolist()))
+        self.states = ys.astype(np.int64) * self.size + xs
+        self.means = self.grid.reward_mean[ys, xs].astype(float)
+        self.stds = np.where(self.grid.deterministic[ys, xs], 0, self.grid.reward_std[ys, xs])
+        self.rewards = self.means.copy()
+        self.successors = np.full((len(self.states), len(DIRECTIONS)), self.padding, dtype=np.int64)
+        self.weights = np.zeros((len(self.states), len(DIRECTIONS)))
+        self.outcomes = np.zeros((len(self.states), len(DIRECTIONS)))
+
+        self.rows = np.full(self.padding + 1, -1, dtype=np.int64)
+        self.rows[self.states] = np.arange(len(self.states))
+        states, actions, successors, probabilities = model.transition_arrays()
+        keep = self.rows[states] >= 0
+        states, actions, successors, probabilities = states[keep], actions[keep], successors[keep], probabilities[keep]
+        slots = self.slot(states, successors)
+        self.successors[self.rows[states], slots] = successors
+        np.add.at(self.weights, (self.rows[states], slots), probabilities)
+        np.add.at(self.outcomes, (self.rows[states], actions), probabilities)
+        self.valid = self.successors != self.padding
+
+        # Two interleaved halves of a checkerboard, used for in-place sweeps
+        parity = (self.states // self.size + self.states % self.size) % 2
+        self.colors = [np.flatnonzero(parity == 0), np.flatnonzero(parity == 1)]
+        self.layers = None
+
+    def sample_rewards(self, rng) :
+        """Replaces the rewards by one normal draw per state, keeping deterministic cells at their mean"""
+        self.rewards = rng.normal(self.means, self.stds)
+
+    def index(self, state) :
+        return state[1] * self.size + state[0]
+
+    def direction(self, state, neighbor) :
+        return OFFSETS.index((neighbor[0] - state[0], neighbor[1] - state[1]))
+
+    def slot(self, states, successors) :
+        offsets = np.asarray(successors, dtype=np.int64) - states
+        return np.select([offsets == -1, offsets == -self.size, offsets == 1], [0, 1, 2], 3)
+
+    def squares(self, new, old) :
+        with np.errstate(invalid="ignore") :
+            diff = np.where(new == old, 0, new - old)
+        return float(np.sum(diff ** 2))
+
+    def assign(self, indices, new) :
+        """Writes new values and returns the sum of their squared changes"""
+        total = self.squares(new, self.values[indices])
+        self.values[indices] = new
+        return total
+
+    def backup(self, rows) :
+        vals = self.rewards[rows, None] + self.weights[rows] * self.values[self.successors[rows]]
+        vals = np.where(self.valid[rows], vals, -np.inf)
+        return np.round(vals.max(axis=1), 3)
+
+    def distance_layers(self) :
+        """Returns the rows of the states one, two, ... moves away from the End, in breadth-first order
+
+        States without a path of valid moves to the End are in no layer.
+        """
+        rows, slots = np.nonzero(self.valid)
+        targets = self.successors[rows, slots]
+        order = np.argsort(targets, kind="stable")
+        predecessors = rows[order]
+        starts = np.searchsorted(targets[order], np.arange(self.padding + 1))
+        counts = np.bincount(targets, minlength=self.padding + 1)
+        reached = np.zeros(len(self.states), dtype=bool)
+        frontier, layers = np.array([self.terminal]), []
+        while len(frontier) :
+            candidates = np.unique(predecessors[ranges(starts[frontier], counts[frontier])])
+            layer = candidates[~reached[candidates]]
+            reached[layer] = True
+            frontier = self.states[layer]
+            if len(layer) :
+                layers.append(layer)
+        return layers
+
+    def mask_unreachable(self) :
+        """Sets the states that cannot reach the End to minus infinity and orders the rest by distance
+
+        Value backups keep those states at minus infinity, instead of letting them drift down
+        by their reward on every sweep and hold the residual above any tolerance. The distance
+        layers of the other states become the order of asynchronous value sweeps.
+        """
+        self.layers = self.distance_layers()
+        reached = np.zeros(len(self.states), dtype=bool)
+        for rows in self.layers :
+            reached[rows] = True
+        self.values[self.states[~reached]] = -np.inf
+
+    def start_below(self) :
+        """Replaces the values by those of following a breadth-first tree to the End
+
+        Every layer is backed up from the layers before it, so each state starts at the value
+        of some path to the End, below its optimal value. Backups from below only ever move
+        values up, and an asynchronous sweep in layer order carries every improvement from
+        the End to the farthest state at once, where values started above the solution sink
+        by a single reward per sweep.
+        """
+        self.values[self.states] = -np.inf
+        self.values[self.terminal] = 100
+        with np.errstate(invalid="ignore") :
+            for rows in self.layers :
+                self.values[self.states[rows]] = self.backup(rows)
+
+    def value_sweep(self, synchronous) :
+        """Performs one value iteration sweep and returns the L2 change of the values
+
+        A synchronous sweep backs up every state from the previous values at once, like
+        value_iter_sync. An asynchronous sweep updates groups of states in place, so later
+        groups already see the values written by earlier ones: the distance layers once
+        mask_unreachable ran, the two checkerboard halves otherwise. That is a different
+        order than value_iter_async, so the values of the epochs and the epoch count differ
+        from the dict path, only the converged values agree.
+        """
+        if synchronous :
+            total = self.assign(self.states, self.backup(slice(None)))
+        else :
+            groups = self.colors if self.layers is None else self.layers
+            total = sum(self.assign(self.states[rows], self.backup(rows)) for rows in groups)
+        total += self.assign(self.terminal, 100)
+        return float(np.sqrt(total))
+
+    def policy_array(self, policy) :
+        """Converts a policy dict into a (states, 4) array of action probabilities"""
+        if hasattr(policy, "probability_array") :
+            return policy.probability_array(self.states)
+        result = np.zeros((len(self.states), len(DIRECTIONS)))
+        for row, state in enumerate(self.coordinates) :
+            for neighbor, probability in policy[state].items() :
+                result[row, self.direction(state, neighbor)] = probability
+        return result
+
+    def evaluation_backup(self, pi, rows) :
+        vals = pi[rows] * self.outcomes[rows] * self.values[self.successors[rows]]
+        return self.rewards[rows] + np.sum(np.where(pi[rows] > 0, vals, 0), axis=1)
+
+    def policy_sweep(self, pi, synchronous) :
+        portals = list(self.portals)
+        starts = self.values[portals]
+        if synchronous :
+            total = self.assign(self.states, self.evaluation_backup(pi, slice(None)))
+        else :
+            total = sum(self.assign(self.states[rows], self.evaluation_backup(pi, rows)) for rows in self.colors)
+        total += self.assign(self.terminal, 100)
+
+        # The portals exchange the values they were just given, like policy_eval_sync
+        computed = self.values[portals]
+        self.values[portals] = computed[::-1]
+        total += self.squares(computed[::-1], starts) - self.squares(computed, starts)
+        return float(np.sqrt(max(total, 0)))
+
+    def linear_system(self, pi) :
+        """Builds the policy evaluation system V = S(b + A V) over the active states
+
+        A holds the probabilities of moving between active states, b the rewards plus the
+        End value reached directly, and S swaps the rows of the two portals like
+        policy_eval_sync does after every sweep. Returns the entries of S A, S b and the
+        rows that reach the End in one step.
+        """
+        rows, slots = np.nonzero(self.valid & (pi > 0))
+        coefficients = pi[rows, slots] * self.outcomes[rows, slots]
+        columns = self.rows[self.successors[rows, slots]]
+        b = self.rewards.copy()
+        ends = columns < 0
+        np.add.at(b, rows[ends], coefficients[ends] * 100)
+
+        swap = np.arange(len(self.states))
+        top, bottom = self.rows[self.portals[0]], self.rows[self.portals[1]]
+        if top >= 0 and bottom >= 0 :
+            swap[top], swap[bottom] = bottom, top
+        return swap[rows[~ends]], columns[~ends], coefficients[~ends], b[swap], swap[rows[ends]]
+
+    def proper_states(self, rows, columns, terminal_rows) :
+        """Returns a mask of the states that reach the End with probability 1"""
+        count = len(self.states)
+        order = np.argsort(columns, kind="stable")
+        predecessors = rows[order]
+        pointers = np.searchsorted(columns[order], np.arange(count + 1))
+
+        def spread(marked) :
+            """Marks every predecessor of the marked states, one layer at a time"""
+            frontier = np.flatnonzero(marked)
+            while len(frontier) :
+                found = predecessors[ranges(pointers[frontier], pointers[frontier + 1] - pointers[frontier])]
+                frontier = np.unique(found[~marked[found]])
+                marked[frontier] = True
+            return marked
+
+        reaching = np.zeros(count, dtype=bool)
+        reaching[terminal_rows] = True
+        # Any chance of entering a state that never reaches the End is a chance of never finishing
+        return ~spread(~spread(reaching))
+
+    def solve_policy(self, pi, tolerance, iterations = 10000) :
+        """Evaluates a policy exactly and returns the L2 change of the values
+
+        The linear system is solved with a sparse LU factorization, or with Jacobi iterations
+        warm-started from the current values when SciPy is not installed. States that cannot
+        reach the End with certainty get a value of minus infinity. When the Jacobi iterations,
+        capped at iterations steps, do not converge, a RuntimeWarning is issued and the values
+        they reached are kept.
+        """
+        try :
+            from scipy.sparse import csc_matrix, identity
+            from scipy.sparse.linalg import spsolve
+        except ImportError :
+            csc_matrix = None
+
+        rows, columns, coefficients, b, terminal_rows = self.linear_system(pi)
+        proper = self.proper_states(rows, columns, terminal_rows)
+        keep = proper[rows]
+        position = np.cumsum(proper) - 1
+        rows, columns, coefficients = position[rows[keep]], position[columns[keep]], coefficients[keep]
+        b, count = b[proper], int(np.count_nonzero(proper))
+
+        if count == 0 :
+            solution = b
+        elif csc_matrix is not None :
+            matrix = identity(count, format="csc") - csc_matrix((coefficients, (rows, columns)), shape=(count, count))
+            solution = np.atleast_1d(spsolve(matrix, b))
+        else :
+            solution = self.values[self.states[proper]]
+            solution = np.where(np.isfinite(solution), solution, 0)
+            for _ in range(iterations) :
+                previous, solution = solution, b + np.bincount(rows, coefficients * solution[columns], minlength=count)
+                if np.max(np.abs(solution - previous)) < tolerance / 100 :
+                    break
+            else :
+                warnings.warn(f"Jacobi iterations did not converge in {iterations} iterations", RuntimeWarning)
+
+        values = np.full(len(self.states), -np.inf)
+        values[proper] = solution
+        total = self.assign(self.states, values) + self.assign(self.terminal, 100)
+        return float(np.sqrt(total))
+
+    def load(self, value_function) :
+        """Writes the values of a value function dict into the engine"""
+        self.values[self.states] = [value_function[state] for state in self.coordinates]
+        self.values[self.terminal] = value_function[self.grid.end]
+
+    def value_function(self) :
+        result = {state : float(value) for state, value in zip(self.coordinates, self.values[self.states])}
+        result[self.grid.end] = 100
+        return result
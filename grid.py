@@ -1,10 +1,29 @@
 from cell import *
-import random, math
+import math
+import numpy as np
 
 class Grid :
-    def __init__(self, size, obstacles = 0.5, traps = 0.1, rest = 0.05) :
-        self.entries = [[None for i in range(size)] for j in range(size)]
+    def __init__(self, size, obstacles = 0.5, traps = 0.1, rest = 0.05, seed = None, rng = None) :
+        """Generates a random grid with guaranteed paths from the Start and both portals to the End
+
+        Args:
+            size (int): The side length of the grid
+            obstacles (float, optional): The probability of an obstacle off the guaranteed paths. Defaults to 0.5.
+            traps (float, optional): The probability of a trap. Defaults to 0.1.
+            rest (float, optional): The probability of a rest area. Defaults to 0.05.
+            seed (int, optional): The seed of the random generator, for reproducible grids. Defaults to None.
+            rng (numpy.random.Generator, optional): A generator to draw from instead of seeding one. Defaults to None.
+        """
+        # Cells are stored in arrays indexed [y, x], like the rows of entries
+        self.types = np.zeros((size, size), dtype=np.uint8)
+        self.reward_mean = np.full((size, size), -1, dtype=np.float32)
+        self.reward_std = np.ones((size, size), dtype=np.float32)
+        self.deterministic = np.ones((size, size), dtype=bool)
+        self.neighbor_mask = np.zeros((size, size), dtype=np.uint8) # Bit k set if DIRECTIONS[k] is accessible
+        self.portals = {}
         self.size = size
+        self.seed = seed
+        self.rng = rng if rng is not None else np.random.default_rng(seed)
         self.path = [] # Guaranteed path from S to E
         self.cells = [] # Guaranteed path from portals to path
         self.obstacle_number = obstacles # Percentage of obstacles in remaining cells
@@ -31,7 +50,6 @@ class Grid :
         self.corners = [(0, 0), (size - 1, size - 1), self.portal_bottom, self.portal_top]
 
         # Fill the rest with obstacles and switches
-        self.obstacles = []
         self.random_rest()
         
         self[0, 0] = Start()
@@ -45,15 +63,118 @@ class Grid :
 
     def __getitem__(self, coordinates) :
         if isinstance(coordinates, tuple) :
-            return self.entries[coordinates[1]][coordinates[0]]
+            x, y = coordinates
+            return CELL_TYPES[self.types[y, x]].view(self, x, y)
         else :
-            return self.entries[coordinates]
+            return [self[x, coordinates] for x in range(self.size)]
     
-    def __setitem__(self, coordinates, x) :
-        if isinstance(coordinates, tuple) :
-            self.entries[coordinates[1]][coordinates[0]] = x
+    def __setitem__(self, coordinates, cell) :
+        if not isinstance(coordinates, tuple) :
+            for x, entry in enumerate(cell) :
+                self[x, coordinates] = entry
+            return
+        x, y = coordinates
+        self.types[y, x] = cell.kind
+        self.reward_mean[y, x] = np.nan if isinstance(cell, Obstacle) else cell.reward_mean
+        self.reward_std[y, x] = cell.reward_std
+        self.deterministic[y, x] = cell.deterministic
+        if isinstance(cell, Portal) :
+            self.portals[coordinates] = cell.towards
         else :
-            self.entries[coordinates] = x
+            self.portals.pop(coordinates, None)
+
+    def set_cell(self, coordinates, cell) :
+        """Replaces the cell at coordinates and updates the neighbor masks around it
+
+        Only plain cells, traps, rest areas and obstacles can be placed, and obstacles stay
+        off the guaranteed paths so the End remains reachable. A neighbor left without any
+        accessible cell becomes an obstacle, like adjacency does.
+
+        Args:
+            coordinates (tuple): The (x, y) position of the cell to replace
+            cell (Cell): The new cell
+
+        Returns:
+            list: The coordinates whose type or neighbors changed, to pass to Model.update
+        """
+        if coordinates in self.corners :
+            raise ValueError("The Start, the End and the portals cannot be edited")
+        if type(cell) not in (Cell, Obstacle, Trap, RestArea) :
+            raise TypeError(f"Cannot place a {type(cell).__name__}")
+        if isinstance(cell, Obstacle) and coordinates in self.paths :
+            raise ValueError("Obstacles cannot block the guaranteed paths")
+        self[coordinates] = cell
+        changed = {coordinates}
+        pending = [coordinates]
+        while pending :
+            x, y = pending.pop()
+            for i, j in [(x, y)] + self.inside(x, y) :
+                mask = self.cell_mask(i, j)
+                if mask != self.neighbor_mask[j, i] :
+                    self.neighbor_mask[j, i] = mask
+                    changed.add((i, j))
+                if mask == 0 and self.types[j, i] != Obstacle.kind :
+                    self[i, j] = Obstacle()
+                    changed.add((i, j))
+                    pending.append((i, j))
+        return sorted(changed)
+
+    def inside(self, x, y) :
+        """Returns the coordinates next to (x, y) that lie on the grid, in DIRECTIONS order"""
+        return [(x + dx, y + dy) for dx, dy in OFFSETS if 0 <= x + dx < self.size and 0 <= y + dy < self.size]
+
+    def cell_mask(self, x, y) :
+        mask = 0
+        for k, (dx, dy) in enumerate(OFFSETS) :
+            i, j = x + dx, y + dy
+            if 0 <= i < self.size and 0 <= j < self.size and self.types[j, i] != Obstacle.kind :
+                mask |= 1 << k
+        return mask
+
+    def neighbor_coordinates(self, x, y) :
+        return [(x + dx, y + dy) for _, dx, dy in NEIGHBOR_TABLE[self.neighbor_mask[y, x]]]
+
+    @classmethod
+    def from_arrays(cls, arrays, obstacles = 0.5, traps = 0.1, rest = 0.05, seed = None) :
+        """Rebuilds a grid from the arrays returned by to_arrays without generating it again"""
+        grid = cls.__new__(cls)
+        grid.size = arrays["types"].shape[0]
+        for name in ["types", "reward_mean", "reward_std", "deterministic", "neighbor_mask"] :
+            setattr(grid, name, arrays[name])
+        grid.obstacle_number, grid.traps, grid.rest, grid.seed = obstacles, traps, rest, seed
+        grid.rng = np.random.default_rng(seed)
+        grid.path = [tuple(point) for point in arrays["path"].tolist()]
+        grid.cells = [tuple(point) for point in arrays["cells"].tolist()]
+        grid.paths = grid.path + grid.cells
+        grid.start, grid.end = (0, 0), (grid.size - 1, grid.size - 1)
+        grid.portal_top, grid.portal_bottom = (grid.size - 1, 0), (0, grid.size - 1)
+        grid.corners = [grid.start, grid.end, grid.portal_bottom, grid.portal_top]
+        grid.portals = {tuple(portal) : tuple(towards) for portal, towards in arrays["portals"].tolist()}
+        return grid
+
+    def to_arrays(self) :
+        return {
+            "types" : self.types,
+            "reward_mean" : self.reward_mean,
+            "reward_std" : self.reward_std,
+            "deterministic" : self.deterministic,
+            "neighbor_mask" : self.neighbor_mask,
+            "path" : np.array(self.path, dtype=np.int32).reshape(-1, 2),
+            "cells" : np.array(self.cells, dtype=np.int32).reshape(-1, 2),
+            "portals" : np.array([[portal, towards] for portal, towards in self.portals.items()], dtype=np.int32).reshape(-1, 2, 2),
+        }
+
+    @property
+    def obstacles(self) :
+        i, j = np.nonzero(self.types.T == Obstacle.kind)
+        return list(zip(i.tolist(), j.tolist()))
+
+    @property
+    def entries(self) :
+        return [self[j] for j in range(self.size)]
+
+    def nbytes(self) :
+        return sum(x.nbytes for x in [self.types, self.reward_mean, self.reward_std, self.deterministic, self.neighbor_mask])
 
     def __repr__(self) :
         corner = "\\"
@@ -67,76 +188,72 @@ class Grid :
             i += 1
         return result
     
-    def create_path(self, start, end, path) :
-        reverseX = start[0] <= end[0]
-        reverseY = start[1] <= end[1]
-        deltaX = 1 if reverseX else -1
-        deltaY = 1 if reverseY else -1
+    def fill(self, mask, cell) :
+        """Stores a copy of cell in every position where mask is set"""
+        self.types[mask] = cell.kind
+        self.reward_mean[mask] = np.nan if isinstance(cell, Obstacle) else cell.reward_mean
+        self.reward_std[mask] = cell.reward_std
+        self.deterministic[mask] = cell.deterministic
 
+    def create_path(self, start, end, path) :
         if type(start) != tuple or type(end) != tuple :
             raise TypeError("Coordinates must be integer tuples")
+        deltaX = 1 if start[0] <= end[0] else -1
+        deltaY = 1 if start[1] <= end[1] else -1
+
+        # Walks diagonally with one coin flip per step until a coordinate is aligned, then straight
         x, y = start
-        while (x, y) != end :
-            if x == end[0] :
-                while y != end[1] :
-                    path.append((x, y))
-                    self[x, y] = Cell()
-                    y += deltaY
-                return
-            elif y == end[1] :
-                while x != end[0] :
-                    path.append((x, y))
-                    self[x, y] = Cell()
-                    x += deltaX
-                return
+        flips = self.rng.integers(1, 3, size=abs(end[0] - x) + abs(end[1] - y))
+        for flip in flips :
+            if x == end[0] or y == end[1] :
+                break
+            path.append((x, y))
+            if flip == 1 :
+                x += deltaX
             else :
-                path.append((x, y))
-                self[x, y] = Cell()
-                if random.randint(1, 2) == 1 :
-                    x += deltaX
-                else :
-                    y += deltaY
+                y += deltaY
+        while x != end[0] :
+            path.append((x, y))
+            x += deltaX
+        while y != end[1] :
+            path.append((x, y))
+            y += deltaY
     
     def random_rest(self) :
-        for i in range(self.size) :
-            for j in range(self.size) :
-                x = random.random()
-                self[i, j] = Cell()
-                if not any([(i, j) in li for li in [self.corners, self.path, self.cells]]) :
-                    if x < self.obstacle_number :
-                        self[i, j] = Obstacle()
-                        self.obstacles.append((i, j))
-                if x < self.obstacle_number + self.traps and x > self.obstacle_number:
-                    self[i, j] = Trap()
-                if x < self.obstacle_number + self.traps + self.rest and x > self.obstacle_number + self.traps:
-                    self[i, j] = RestArea()
+        x = self.rng.random((self.size, self.size))
+        protected = np.zeros((self.size, self.size), dtype=bool)
+        for li in [self.corners, self.path, self.cells] :
+            if li :
+                i, j = np.array(li).T
+                protected[j, i] = True
+
+        obstacles = ~protected & (x < self.obstacle_number)
+        traps = (x < self.obstacle_number + self.traps) & (x > self.obstacle_number)
+        rest = (x < self.obstacle_number + self.traps + self.rest) & (x > self.obstacle_number + self.traps)
+        self.fill(np.ones((self.size, self.size), dtype=bool), Cell())
+        self.fill(obstacles, Obstacle())
+        self.fill(traps, Trap())
+        self.fill(rest, RestArea())
                 
     def get_other_portal(self, key) :
         return (0, self.size - 1) if key == (self.size - 1, 0) else (self.size - 1, 0) 
 
     def get_target(self, portal) :
-        distances = [self.distance(portal, point) for point in self.path]
-        return self.path[distances.index(min(distances))]
+        points = np.array(self.path)
+        distances = np.sum((points - np.array(portal)) ** 2, axis=1)
+        return self.path[int(np.argmin(distances))]
     
     def distance(self, cell1, cell2) :
         return math.sqrt(int(abs(cell1[0] - cell2[0]) ** 2 + abs(cell1[1] - cell2[1]) ** 2))
     
     def adjacency(self) :
-        for i in range(self.size) :
-            for j in range(self.size) :
-                if i != 0 and not type(self[i - 1, j]) == Obstacle:
-                    self[i, j].neighbors["left"] = (i - 1, j)
-                if j != 0 and not type(self[i, j - 1]) == Obstacle :
-                    self[i, j].neighbors["up"] = (i, j - 1)
-                if i != self.size - 1 and not type(self[i + 1, j]) == Obstacle :
-                    self[i, j].neighbors["right"] = (i + 1, j)
-                if j != self.size - 1 and not type(self[i, j + 1]) == Obstacle :
-                    self[i, j].neighbors["down"] = (i, j + 1)
+        open_cells = np.pad(self.types != Obstacle.kind, 1)
+        self.neighbor_mask[:] = 0
+        for k, (dx, dy) in enumerate(OFFSETS) :
+            accessible = open_cells[1 + dy:1 + dy + self.size, 1 + dx:1 + dx + self.size]
+            self.neighbor_mask |= accessible.astype(np.uint8) << k
         
-        for i in range(self.size) :
-            for j in range(self.size) :
-                if len(self[i, j].neighbors) == 0 :
-                    self[i, j] = Obstacle()
+        self.fill(self.neighbor_mask == 0, Obstacle())
     
     def reward_map(self) :
         result = "".join([f"{num:^5}" for num in range(-1, self.size)]) + "\n"
@@ -0,0 +1,55 @@
+import cProfile, json, pstats
+
+class PrintObserver :
+    """Prints the messages of events, like derive_policy used to"""
+    def __call__(self, event) :
+        if "message" in event :
+            print(event["message"])
+
+class TraceCollector :
+    def __init__(self, path = None) :
+        """Collects the events of a policy algorithm and optionally writes them to a trace file
+
+        Args:
+            path (str, optional): A file receiving one JSON object per event. Defaults to None.
+        """
+        self.events = []
+        self.file = open(path, "w") if path else None
+
+    def __call__(self, event) :
+        self.events.append(event)
+        if self.file :
+            self.file.write(json.dumps(event) + "\n")
+            self.file.flush()
+
+    def close(self) :
+        if self.file :
+            self.file.close()
+            self.file = None
+
+    def summary(self) :
+        """Returns the epoch count, total backups and total wall time spent in each phase"""
+        epochs = [event for event in self.events if event["event"] == "epoch"]
+        times = {}
+        for event in epochs :
+            for phase, elapsed in event["times"].items() :
+                times[phase] = times.get(phase, 0) + elapsed
+        return {"epochs" : len(epochs), "backups" : sum(event["backups"] for event in epochs), "times" : times}
+
+def profile(algorithm, path = None, limit = 20) :
+    """Runs derive_policy under cProfile and emits a "profile" event with the hottest functions
+
+    Args:
+        algorithm (PolicyAlgorithm): The algorithm to run
+        path (str, optional): A file to dump the raw profiler stats to. Defaults to None.
+        limit (int, optional): The number of functions listed in the event. Defaults to 20.
+    """
+    profiler = cProfile.Profile()
+    diffs = profiler.runcall(algorithm.derive_policy)
+    if path :
+        profiler.dump_stats(path)
+    stats = pstats.Stats(profiler)
+    hottest = sorted(stats.stats.items(), key=lambda item : item[1][3], reverse=True)[:limit]
+    algorithm.emit("profile", functions=[{"function" : f"{name[0]}:{name[1]}({name[2]})", "calls" : calls, "total_time" : total, "cumulative_time" : cumulative}
+                                         for name, (_, calls, total, cumulative, _) in hottest])
+    return diffs
@@ -0,0 +1,227 @@
+import argparse, time
+import numpy as np
+from cell import Obstacle, End, DIRECTIONS, OFFSETS
+from grid import Grid
+from model import Model
+from policy import PolicyAlgorithm, ValueIteration
+
+class GridWorldEnv :
+    def __init__(self, model, envs = 1, seed = None, max_steps = None, starts = "random", sample_rewards = False) :
+        """A batch of GridWorld environments stepping together as arrays
+
+        Observations are flat state indices y * size + x and actions are DIRECTIONS slots.
+        Leaving a state pays its reward, the successor is drawn from the transition table of
+        the model, entering a portal moves to the other portal and entering the End pays 100
+        and ends the episode. Finished or truncated environments are reset right away.
+
+        Args:
+            model (Model): The model of the environment
+            envs (int, optional): The number of environments. Defaults to 1.
+            seed (int, optional): The seed of the generator of the environments. Defaults to None.
+            max_steps (int, optional): The step limit of an episode. Defaults to 4 * size ** 2.
+            starts (str, optional): "random" to start episodes in any state with an action, or
+                "start" to start them all on the Start of the grid. Defaults to "random".
+            sample_rewards (boolean, optional): Whether the rewards of stochastic cells are drawn
+                from their normal distribution instead of taking their mean. Defaults to False.
+        """
+        if starts not in ("random", "start") :
+            raise ValueError(f"Unknown starts {starts}")
+        self.model = model
+        self.grid = model.grid
+        self.size = self.grid.size
+        self.envs = envs
+        self.rng = np.random.default_rng(seed)
+        self.max_steps = max_steps if max_steps is not None else 4 * self.size ** 2
+        self.sample_rewards = sample_rewards
+        cells = self.size ** 2
+        self.end = self.grid.end[1] * self.size + self.grid.end[0]
+
+        self.means = np.nan_to_num(self.grid.reward_mean.ravel().astype(float))
+        self.stds = np.where(self.grid.deterministic.ravel(), 0, self.grid.reward_std.ravel().astype(float))
+        self.teleport = np.arange(cells)
+        for (x, y), (i, j) in self.grid.portals.items() :
+            self.teleport[y * self.size + x] = j * self.size + i
+
+        # Up to four outcomes per (state, slot) pair, as successors and a cumulative distribution
+        states, slots, successors, probabilities = model.transition_arrays()
+        pairs = states.astype(np.int64) * len(DIRECTIONS) + slots
+        first = np.searchsorted(pairs, pairs)
+        rank = np.arange(len(pairs)) - first
+        cumulative = np.cumsum(probabilities)
+        cumulative -= (cumulative - probabilities)[first]
+        self.counts = np.bincount(pairs, minlength=cells * len(DIRECTIONS))
+        self.successors = np.zeros((cells * len(DIRECTIONS), 4), dtype=np.int64)
+        self.successors[pairs, rank] = successors
+        self.cdf = np.full((cells * len(DIRECTIONS), 4), np.inf)
+        self.cdf[pairs, rank] = cumulative
+
+        active = ~np.isin(self.grid.types.ravel(), [Obstacle.kind, End.kind])
+        self.valid = (self.counts.reshape(cells, len(DIRECTIONS)) > 0) & active[:, None]
+        self.start_states = np.flatnonzero(self.valid.any(axis=1)) if starts == "random" else np.array([self.grid.start[1] * self.size + self.grid.start[0]])
+        self.positions = np.zeros(envs, dtype=np.int64)
+        self.steps = np.zeros(envs, dtype=np.int64)
+        self.reset()
+
+    def reset(self, mask = None) :
+        """Starts new episodes in every environment, or only where mask is set, and returns the positions"""
+        mask = np.ones(self.envs, dtype=bool) if mask is None else mask
+        self.positions[mask] = self.teleport[self.rng.choice(self.start_states, int(np.count_nonzero(mask)))]
+        self.steps[mask] = 0
+        return self.positions
+
+    def step(self, actions) :
+        """Moves every environment by one action
+
+        Returns:
+            tuple: The successors, the rewards, whether the End was entered and whether the step
+                limit was hit, one entry per environment. self.positions already holds the
+                reset positions of the environments that finished.
+        """
+        pairs = self.positions * len(DIRECTIONS) + actions
+        u = self.rng.random(self.envs)
+        outcome = np.minimum((u[:, None] >= self.cdf[pairs]).sum(axis=1), np.maximum(self.counts[pairs] - 1, 0))
+        successors = self.teleport[self.successors[pairs, outcome]]
+        rewards = self.rng.normal(self.means[self.positions], self.stds[self.positions]) if self.sample_rewards else self.means[self.positions]
+        terminal = successors == self.end
+        rewards = rewards + 100 * terminal
+        self.steps += 1
+        truncated = ~terminal & (self.steps >= self.max_steps)
+        self.positions = successors.copy()
+        finished = terminal | truncated
+        if finished.any() :
+            self.reset(finished)
+        return successors, rewards, terminal, truncated
+
+class QLearning(PolicyAlgorithm) :
+    def __init__(self, grid, model, envs = 1024, steps = 200, alpha = 0.1, epsilon = 0.1, discount = 1.0, epochs = 200, seed = None, **env_options) :
+        """Tabular Q-learning over a batch of environments, with an array Q-table
+
+        Every epoch runs steps batched steps, so envs * steps transitions, and exports the
+        greedy policy and its values into the policy and value function dicts, so learned
+        policies compare directly with the planners through arrow_grid. The residual is the
+        L2 change of the greedy values over the epoch. Environments of a step that share a
+        state and action update it once with the mean of their TD errors, and backups counts
+        those updates, not the transitions.
+
+        Args:
+            envs (int, optional): The number of environments stepped together. Defaults to 1024.
+            steps (int, optional): The number of batched steps per epoch. Defaults to 200.
+            alpha (float, optional): The learning rate. Defaults to 0.1.
+            epsilon (float, optional): The exploration probability. Defaults to 0.1.
+            discount (float, optional): The discount factor, 1 like the planners. Defaults to 1.0.
+            epochs (int, optional): The maximum number of epochs. Defaults to 200.
+            seed (int, optional): The seed of the environments and of the exploration. Defaults to None.
+            env_options: Further arguments of GridWorldEnv
+        """
+        super().__init__(grid, model, epochs=epochs, seed=seed)
+        self.env = GridWorldEnv(model, envs, seed=self.rng.integers(2 ** 32), **env_options)
+        self.steps = steps
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.discount = discount
+        self.q = np.zeros((grid.size ** 2, len(DIRECTIONS)))
+        self.actions = self.choose(self.env.positions)
+        self.states = np.array([y * grid.size + x for x, y in self.value_function if (x, y) != grid.end], dtype=np.int64)
+        self.greedy = self.greedy_values()
+
+    def greedy_values(self) :
+        return np.where(self.env.valid[self.states], self.q[self.states], -np.inf).max(axis=1)
+
+    def choose(self, positions) :
+        """Picks epsilon-greedy valid actions for a batch of positions"""
+        valid = self.env.valid[positions]
+        greedy = np.where(valid, self.q[positions], -np.inf).argmax(axis=1)
+        explore = np.argmax(self.rng.random(valid.shape) * valid, axis=1)
+        return np.where(self.rng.random(len(positions)) < self.epsilon, explore, greedy)
+
+    def bootstrap(self, successors) :
+        """Returns the value of the successors that the update target builds on"""
+        return np.where(self.env.valid[successors], self.q[successors], -np.inf).max(axis=1)
+
+    def train_step(self) :
+        states, actions = self.env.positions, self.actions
+        successors, rewards, terminal, _ = self.env.step(actions)
+        upcoming = self.bootstrap(successors)
+        target = rewards + self.discount * np.where(terminal | ~np.isfinite(upcoming), 0, upcoming)
+        # Environments sharing a state and action move it once, by the mean of their errors
+        pairs, inverse = np.unique(states * len(DIRECTIONS) + actions, return_inverse=True)
+        errors = np.bincount(inverse, weights=target - self.q[states, actions]) / np.bincount(inverse)
+        self.q.flat[pairs] += self.alpha * errors
+        self.actions = self.next_actions(successors)
+        self.backups += len(pairs)
+
+    def next_actions(self, successors) :
+        return self.choose(self.env.positions)
+
+    def train(self) :
+        for _ in range(self.steps) :
+            self.train_step()
+
+    def process(self) :
+        self.timed("backup", self.train)
+        self.timed("improvement", self.export)
+        greedy = self.greedy_values()
+        with np.errstate(invalid="ignore") :
+            self.residual = float(np.sqrt(np.sum(np.where(greedy == self.greedy, 0, greedy - self.greedy) ** 2)))
+        self.greedy = greedy
+        return self.residual
+
+    def export(self) :
+        """Writes the greedy policy and its values into the policy and value function dicts"""
+        size = self.grid.size
+        slots = np.where(self.env.valid, self.q, -np.inf).argmax(axis=1)
+        values = self.greedy_values().tolist()
+        for state, value in zip(self.states.tolist(), values) :
+            self.value_function[(state % size, state // size)] = value
+        self.value_function[self.grid.end] = 100
+        self.policy_changes = 0
+        for (x, y), probabilities in self.policy.items() :
+            dx, dy = OFFSETS[slots[y * size + x]]
+            new = {neighbor : int(neighbor == (x + dx, y + dy)) for neighbor in probabilities}
+            if new != probabilities :
+                self.policy_changes += 1
+            self.policy[(x, y)] = new
+        self.policy_changed = self.policy_changes > 0
+
+class Sarsa(QLearning) :
+    """On-policy SARSA, bootstrapping from the action the behaviour policy takes next"""
+    def bootstrap(self, successors) :
+        self.upcoming = self.choose(successors)
+        return self.q[successors, self.upcoming]
+
+    def next_actions(self, successors) :
+        # Environments that did not reset keep the action already drawn for their successor
+        return np.where(self.env.positions == successors, self.upcoming, self.choose(self.env.positions))
+
+def policy_agreement(p, q) :
+    """Returns the fraction of states both algorithms can solve where their arrow_grid symbols match"""
+    first, second = p.arrow_grid(), q.arrow_grid()
+    pairs = [(a, b) for row_a, row_b in zip(first, second) for a, b in zip(row_a, row_b) if a not in ("X", "E") and b not in ("X", "E")]
+    return sum(a == b for a, b in pairs) / len(pairs) if pairs else 1.0
+
+def main(argv = None) :
+    parser = argparse.ArgumentParser(description="Learn a policy model-free and compare it with value iteration")
+    parser.add_argument("--size", type=int, default=15)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--epsilon", type=float, default=0.4, help="Misfire probability of the model")
+    parser.add_argument("--deterministic", action="store_true")
+    parser.add_argument("--agent", choices=["qlearning", "sarsa"], default="qlearning")
+    parser.add_argument("--envs", type=int, default=1024)
+    parser.add_argument("--epochs", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    grid = Grid(args.size, seed=args.seed)
+    model = Model(grid, args.deterministic, args.epsilon, compact=True)
+    agent = (Sarsa if args.agent == "sarsa" else QLearning)(grid, model, envs=args.envs, epochs=args.epochs, seed=args.seed)
+    start = time.perf_counter()
+    agent.derive_policy()
+    elapsed = time.perf_counter() - start
+    planner = ValueIteration(grid, model)
+    planner.derive_policy()
+    print(f"{agent.backups} updates in {elapsed:.2f} s ({agent.backups / elapsed:.0f} per second)")
+    print(f"Agreement with value iteration: {policy_agreement(agent, planner):.1%}")
+    for row in agent.arrow_grid() :
+        print(" ".join(row))
+
+if __name__ == "__main__" :
+    main()
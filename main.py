@@ -1,7 +1,25 @@
 import tkinter as tk
+import math, queue, threading, time
+import numpy as np
+from tkinter import ttk
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from grid import Grid
 from policy import *
 from cell import *
+from instrumentation import PrintObserver
+from matplotlib import colormaps
+
+# Indexed by the kind of a cell
+COLORS = ("white", "black", "blue", "red", "yellow", "green", "pink")
+# Grids with more cells per side are drawn as a single image instead of one item per cell
+RASTER_SIZE = 40
+# Cells of a raster image smaller than this many pixels per side are drawn without arrows
+ARROW_PIXELS = 5
+# Minimum number of seconds between two animation frames
+FRAME_INTERVAL = 0.1
+# Clicking a cell of the unsolved grid turns it into the next of these types
+EDIT_CYCLE = (Cell, Obstacle, Trap, RestArea)
 
 class Visualizer(tk.Tk) :
     def __init__(self):
@@ -15,10 +33,13 @@ class Visualizer(tk.Tk) :
         self.traps = 0.1
         self.synchronous = tk.BooleanVar()
         self.deterministic = tk.BooleanVar()
+        self.animate = tk.BooleanVar()
         self.generate_grid()
         self.frames = {}
+        self.solver = None
+        self.events = queue.Queue()
 
-        for F in (Menu, UnsolvedGrid, ArrowGradient, ValueFunction):
+        for F in (Menu, UnsolvedGrid, ArrowGradient, ValueFunction, Convergence):
             frame = F(self.container, self)
             self.frames[F] = frame
             frame.grid(row=0, column=0, sticky="nsew")
@@ -40,31 +61,111 @@ class Visualizer(tk.Tk) :
 
 
     def generate_grid(self) :
+        # A solve still running on the previous grid must not become its policy
+        if getattr(self, "solver", None) is not None :
+            self.solver.cancel()
         self.grid = Grid(self.n, self.obstacles, self.traps, self.rest)
-        self.model = Model(self.grid, not self.deterministic)
+        self.model = Model(self.grid, not self.deterministic.get())
 
     def find_policy(self, PI) :
+        """Solves the grid on a worker thread and follows its progress on the Convergence page
+
+        The worker only puts events on a queue, which poll drains from the Tk loop, so the
+        window stays responsive. The solved algorithm becomes self.p once it converges.
+        When animating, the ValueFunction page shows the value heatmap of the latest epoch.
+        """
+        if self.solver is not None :
+            return
         if PI :
-            self.p = PolicyIteration(self.grid, model=self.model, synchronous= not self.synchronous)
+            solver = PolicyIteration(self.grid, model=self.model, synchronous= not self.synchronous.get())
+        elif ShortestPathSolver.applicable(self.model) :
+            solver = ShortestPathSolver(self.grid, model=self.model)
         else :
-            self.p = ValueIteration(self.grid, model=self.model, synchronous= not self.synchronous)
-        self.p.convergence_analysis()
+            solver = ValueIteration(self.grid, model=self.model, synchronous= not self.synchronous.get())
+        solver.add_observer(PrintObserver())
+        solver.add_observer(self.events.put)
+        self.solver = solver
+        self.p = None
+        self.frames[Convergence].start(solver)
+        self.show_frame(ValueFunction if self.animate.get() else Convergence)
+        threading.Thread(target=self.solve, args=(solver, self.animate.get()), daemon=True).start()
+        self.after(50, self.poll)
+
+    def edit_cell(self, coordinates) :
+        """Turns the cell at coordinates into the next type of EDIT_CYCLE
+
+        A solved grid is then solved again on the worker thread, starting from the values
+        of the previous solution instead of from scratch.
+        """
+        x, y = coordinates
+        kinds = [kind.kind for kind in EDIT_CYCLE]
+        if self.solver is not None or self.grid.types[y, x] not in kinds :
+            return
+        try :
+            cells = self.grid.set_cell(coordinates, EDIT_CYCLE[(kinds.index(self.grid.types[y, x]) + 1) % len(EDIT_CYCLE)]())
+        except ValueError as e :
+            print(e)
+            return
+        self.model.update(cells)
+        self.frames[UnsolvedGrid].draw_grid()
+        if getattr(self, "p", None) is None :
+            return
+        solver, self.p = self.p, None
+        self.solver = solver
+        self.frames[Convergence].start(solver)
+        threading.Thread(target=self.solve, args=(solver, False, cells), daemon=True).start()
+        self.after(50, self.poll)
+
+    def solve(self, solver, animate = False, cells = None) :
+        try :
+            if cells is not None :
+                solver.resolve(cells)
+            elif animate :
+                # Snapshots reuse their buffers, so only the throttled frames are copied
+                shown = 0
+                for snapshot in solver.iterate() :
+                    if time.perf_counter() - shown >= FRAME_INTERVAL :
+                        shown = time.perf_counter()
+                        self.events.put({"event" : "frame", "values" : snapshot.values.copy()})
+            else :
+                solver.derive_policy()
+        except Exception as e :
+            self.events.put({"event" : "failed", "message" : repr(e)})
+        self.events.put({"event" : "finished"})
+
+    def cancel(self) :
+        if self.solver is not None :
+            self.solver.cancel()
+
+    def poll(self) :
+        page = self.frames[Convergence]
+        while True :
+            try :
+                event = self.events.get_nowait()
+            except queue.Empty :
+                break
+            if event["event"] == "frame" :
+                self.frames[ValueFunction].animate(event["values"])
+                continue
+            if event["event"] == "finished" :
+                if not self.solver.cancelled and page.status != "failed" :
+                    self.p = self.solver
+                self.solver = None
+                page.finish(self.p is not None)
+                if self.p is not None and self.animate.get() :
+                    self.frames[ValueFunction].draw_grid()
+                return
+            page.update_progress(event)
+        page.redraw()
+        self.after(100, self.poll)
 
     def get_color(self, cell) :
-        if isinstance(cell, Obstacle) :
-            return "black"
-        elif isinstance(cell, Portal) :
-            return "blue"
-        elif isinstance(cell, Trap) :
-            return "red"
-        elif isinstance(cell, Start) :
-            return "yellow"
-        elif isinstance(cell, End) :
-            return "green"
-        elif isinstance(cell, RestArea) :
-            return "pink"
-        else :
-            return "white" 
+        return COLORS[cell.kind]
+
+    def type_colors(self) :
+        """Returns the (size, size, 3) uint8 image of the cell colors, indexed [y, x]"""
+        palette = np.array([[channel >> 8 for channel in self.winfo_rgb(color)] for color in COLORS], dtype=np.uint8)
+        return palette[self.grid.types]
 
 class Menu(tk.Frame) :
     def __init__(self, parent, controller) :
@@ -74,7 +175,7 @@ class Menu(tk.Frame) :
         tk.Button(self, text="Generate a grid", command= lambda : self.generate()).pack()
 
         tk.Label(self, text="Grid size:").pack()
-        self.size_spinbox = tk.Spinbox(self, from_=3, to=15, textvariable=tk.StringVar(value="15"))  
+        self.size_spinbox = tk.Spinbox(self, from_=3, to=500, textvariable=tk.StringVar(value="15"))  
         self.size_spinbox.pack()
 
         tk.Label(self, text="Obstacle %:").pack()
@@ -95,6 +196,9 @@ class Menu(tk.Frame) :
         self.sync_button = tk.Checkbutton(self, text="Asynchronous ", variable=controller.synchronous)
         self.sync_button.pack()
 
+        self.animate_button = tk.Checkbutton(self, text="Animate convergence", variable=controller.animate)
+        self.animate_button.pack()
+
     def generate(self):
         self.controller.deterministic.get()
         self.controller.synchronous.get()
@@ -121,7 +225,98 @@ class Menu(tk.Frame) :
     def draw_grid(self) :  
         self.controller.frames[UnsolvedGrid].draw_grid()
 
-class UnsolvedGrid(tk.Frame) :
+class GridCanvas(tk.Frame) :
+    """A page drawing one colored square per cell, with an optional text on top
+
+    Small grids get a rectangle and a text item per cell, created once per grid size and
+    only reconfigured where the color or text changed. Grids with more than RASTER_SIZE
+    cells per side are drawn as a single image with no text, which stays fast for
+    hundreds of cells per side. Pages showing a solution color that image by value.
+    """
+    scale = 1.3
+    font_ratio = 4
+
+    def create_canvas(self) :
+        self.width = 800
+        self.canvas = tk.Canvas(self, width=self.width, height=self.width)
+        self.canvas.pack(padx=50)
+        self.items = None
+        self.drawn = {}
+        self.image = None
+
+    def texts(self) :
+        """Returns the [y][x] table of texts to draw, or None for colors only"""
+        return None
+
+    def heatmap(self) :
+        return self.controller.type_colors()
+
+    def draw_grid(self) :
+        g = self.controller.grid
+        cell_size = self.width / (g.size * self.scale)
+        if g.size > RASTER_SIZE :
+            self.draw_image(g.size, cell_size)
+        else :
+            self.draw_items(g, cell_size)
+
+    def cell_at(self, x, y) :
+        """Returns the coordinates of the cell drawn at pixel (x, y), or None outside the grid"""
+        g = self.controller.grid
+        cell_size = self.width / (g.size * self.scale)
+        if g.size > RASTER_SIZE :
+            # The image is scaled by whole factors, see draw_image
+            cell_size = int(cell_size) if cell_size >= 2 else 1 / math.ceil(1 / cell_size) if cell_size < 1 else 1
+        i, j = int(x // cell_size), int(y // cell_size)
+        return (i, j) if 0 <= i < g.size and 0 <= j < g.size else None
+
+    def draw_items(self, g, cell_size) :
+        texts = self.texts()
+        if self.items is None or len(self.items) != g.size or (texts is not None) != (self.items[0][0][1] is not None) :
+            self.canvas.delete("all")
+            self.image = None
+            self.drawn = {}
+            self.items = [[(self.canvas.create_rectangle(i*cell_size, j*cell_size, (i+1)*cell_size, (j+1)*cell_size, outline="gray"),
+                            None if texts is None else self.canvas.create_text((i+0.5)*cell_size, (j+0.5)*cell_size, fill="black",
+                                                                               font=("Helvetica", int(cell_size / self.font_ratio))))
+                           for i in range(g.size)] for j in range(g.size)]
+
+        for j in range(g.size) :
+            for i in range(g.size) :
+                color, text = COLORS[g.types[j, i]], None if texts is None else texts[j][i]
+                if self.drawn.get((i, j)) == (color, text) :
+                    continue
+                self.drawn[(i, j)] = (color, text)
+                rectangle, label = self.items[j][i]
+                self.canvas.itemconfig(rectangle, fill=color)
+                if label is not None :
+                    self.canvas.itemconfig(label, text=f"{text}")
+
+    def draw_image(self, size, cell_size, rgb = None) :
+        rgb = np.ascontiguousarray(self.heatmap() if rgb is None else rgb, dtype=np.uint8)
+        image = tk.PhotoImage(data=b"P6 %d %d 255\n" % (size, size) + rgb.tobytes(), format="PPM")
+        if cell_size >= 2 :
+            image = image.zoom(int(cell_size))
+        elif cell_size < 1 :
+            image = image.subsample(math.ceil(1 / cell_size))
+        self.canvas.delete("all")
+        self.items = None
+        self.image = image
+        self.canvas.create_image(0, 0, anchor="nw", image=image)
+
+    def value_colors(self, values) :
+        """Colors reachable states by value and everything else black"""
+        size = len(values)
+        with np.errstate(invalid="ignore") :
+            reachable = values >= -size ** 2
+        low, high = (values[reachable].min(), values[reachable].max()) if reachable.any() else (0, 1)
+        scaled = np.where(reachable, (values - low) / ((high - low) or 1), 0)
+        rgb = (colormaps["viridis"](scaled)[..., :3] * 255).astype(np.uint8)
+        rgb[~reachable] = 0
+        return rgb
+
+class UnsolvedGrid(GridCanvas) :
+    scale = 1.6
+
     def __init__(self, parent, controller) :
         super().__init__(parent)
         self.controller = controller
@@ -134,34 +329,101 @@ class UnsolvedGrid(tk.Frame) :
 
         tk.Button(self, text="Compute Arrow Gradient", command=lambda: self.show_values(ArrowGradient)).pack()
         tk.Button(self, text="Compute Value Function", command=lambda: self.show_values(ValueFunction)).pack()
+        tk.Label(self, text="Click a cell to change its type").pack()
 
-        self.width = 800
-        self.canvas = tk.Canvas(self, width=self.width , height=self.width)
+        self.create_canvas()
+        self.canvas.bind("<Button-1>", self.edit)
         self.draw_grid()
-        self.canvas.pack(padx=50)
+
+    def edit(self, event) :
+        coordinates = self.cell_at(event.x, event.y)
+        if coordinates is not None :
+            self.controller.edit_cell(coordinates)
 
     def show_values(self, frameType) :
         if hasattr(self.controller, "p") and self.controller.p :
             self.controller.show_frame(frameType)
 
     def regen(self) :
-        self.canvas.delete("all")
         self.controller.generate_grid()
         self.controller.p = None
         self.draw_grid()
         self.controller.show_frame(UnsolvedGrid)
 
-    def draw_grid(self):
-        self.canvas.delete("all")
-        g = self.controller.grid
-        cell_size = self.width / (g.size * 1.6)
-        for i in range(g.size):
-            for j in range(g.size):
-                cell = g[j, i]
-                color = self.controller.get_color(cell)
-                self.canvas.create_rectangle(j*cell_size, i*cell_size, (j+1)*cell_size, (i+1)*cell_size, fill=color, outline="gray")
-
-class ArrowGradient(tk.Frame) :
+class Convergence(tk.Frame) :
+    def __init__(self, parent, controller) :
+        super().__init__(parent)
+        self.controller = controller
+        tk.Label(self, text="Convergence").pack(pady=10)
+        tk.Button(self, text="Back to Grid", command=lambda: controller.show_frame(UnsolvedGrid)).pack()
+        self.cancel_button = tk.Button(self, text="Cancel", command=controller.cancel)
+        self.cancel_button.pack()
+        self.results = tk.Frame(self)
+        tk.Button(self.results, text="Arrow Gradient", command=lambda: controller.show_frame(ArrowGradient)).pack(side="left")
+        tk.Button(self.results, text="Value Function", command=lambda: controller.show_frame(ValueFunction)).pack(side="left")
+
+        self.progress = ttk.Progressbar(self, length=400, maximum=1.0)
+        self.progress.pack(pady=5)
+        self.label = tk.Label(self, text="")
+        self.label.pack()
+
+        self.figure = Figure(figsize=(6, 4))
+        self.axes = self.figure.add_subplot()
+        self.plot = FigureCanvasTkAgg(self.figure, master=self)
+        self.plot.get_tk_widget().pack(padx=50, pady=10)
+        self.diffs = []
+        self.status = ""
+        self.changed = False
+
+    def start(self, solver) :
+        self.solver = solver
+        self.diffs = []
+        self.status = "running"
+        self.changed = True
+        self.progress["value"] = 0
+        self.label.config(text=f"Solving with {type(solver).__name__}...")
+        self.cancel_button.config(state="normal")
+        self.results.pack_forget()
+        self.redraw()
+
+    def update_progress(self, event) :
+        """Shows the epoch and residual of an event, estimating progress from the residual"""
+        if event["event"] == "epoch" :
+            residual = event["residual"]
+            self.diffs.append(residual)
+            self.changed = True
+            first, tolerance = self.diffs[0], self.solver.tolerance
+            if first > tolerance and tolerance < residual < math.inf :
+                self.progress["value"] = max(self.progress["value"], math.log(first / residual) / math.log(first / tolerance))
+            self.label.config(text=f"Epoch {event['epoch'] + 1}/{self.solver.epochs}, residual {residual:.4g}")
+        elif event["event"] == "failed" :
+            self.status = "failed"
+            self.label.config(text=event["message"])
+        elif "message" in event :
+            self.label.config(text=event["message"])
+
+    def finish(self, solved) :
+        self.cancel_button.config(state="disabled")
+        if solved :
+            self.status = "solved"
+            self.progress["value"] = 1.0
+            self.results.pack(after=self.cancel_button)
+        elif self.status != "failed" :
+            self.status = "cancelled"
+        self.redraw()
+
+    def redraw(self) :
+        if not self.changed :
+            return
+        self.changed = False
+        self.axes.clear()
+        self.axes.scatter(range(len(self.diffs)), self.diffs, s=8)
+        self.axes.set_title("Convergence Analysis of Policy Algorithm")
+        self.axes.set_xlabel("Iteration")
+        self.axes.set_ylabel("Diff")
+        self.plot.draw_idle()
+
+class ArrowGradient(GridCanvas) :
     def __init__(self, parent, controller) :
         super().__init__(parent)
         self.controller = controller
@@ -170,37 +432,63 @@ class ArrowGradient(tk.Frame) :
                   command=lambda: controller.show_frame(Menu)).pack()
         tk.Button(self, text="Value Function",
                   command=lambda: controller.show_frame(ValueFunction)).pack()
-    
-        self.width = 800
-        self.canvas = tk.Canvas(self, width=self.width, height=self.width)
-        self.canvas.pack(padx=50)
-    
+        self.note = tk.Label(self, text="")
+        self.note.pack()
+        self.create_canvas()
+
+    def texts(self) :
+        return self.controller.p.arrow_grid()
+
+    def heatmap(self) :
+        values, _ = self.controller.p.solution_arrays()
+        return self.value_colors(values)
+
+    def arrow_image(self, pixels) :
+        """Returns the value heatmap with pixels x pixels per cell and the arrow of the policy on every reachable state
+
+        Arrows are white on dark cells and black on light ones.
+        """
+        size = self.controller.grid.size
+        values, actions = self.controller.p.solution_arrays()
+        colors = self.value_colors(values)
+        rgb = colors.repeat(pixels, axis=0).repeat(pixels, axis=1)
+
+        # A right arrow, a shaft along the middle row ending in a triangular head, turned for the other directions
+        ys, xs = np.mgrid[:pixels, :pixels]
+        middle, tip, head = (pixels - 1) / 2, pixels - 1 - pixels // 5, max(pixels // 3, 1)
+        right = ((np.abs(ys - middle) < 1) & (xs >= pixels // 5) & (xs <= tip)) | ((xs > tip - head) & (xs <= tip) & (np.abs(ys - middle) <= tip - xs))
+        up = np.rot90(right)
+        sprites = np.stack([right[:, ::-1], up, right, up[::-1]])
+
+        with np.errstate(invalid="ignore") :
+            shown = (actions >= 0) & (values >= -size ** 2)
+        mask = np.where(shown[..., None, None], sprites[np.maximum(actions, 0)], False)
+        mask = mask.transpose(0, 2, 1, 3).reshape(size * pixels, size * pixels)
+        dark = (colors.mean(axis=2) < 128).repeat(pixels, axis=0).repeat(pixels, axis=1)
+        rgb[mask & dark] = 255
+        rgb[mask & ~dark] = 0
+        return rgb
+
     def draw_grid(self):    
         if not hasattr(self.controller, "p") or self.controller.p is None:
             print("Policy not yet computed.")
             return
-        
-        self.canvas.delete("all")
         g = self.controller.grid
-        cell_size = self.width / (g.size * 1.3)
-        for i in range(g.size):
-            for j in range(g.size):
-                cell = g[i, j]
-                color = self.controller.get_color(cell)
-                x0 = i * cell_size
-                y0 = j * cell_size
-                x1 = (i + 1) * cell_size
-                y1 = (j + 1) * cell_size
-
-                self.canvas.create_rectangle(x0, y0, x1, y1, fill=color, outline="gray")
-
-                text_x = (x0 + x1) / 2
-                text_y = (y0 + y1) / 2
+        pixels = int(self.width / (g.size * self.scale))
+        if g.size <= RASTER_SIZE :
+            self.note.config(text="")
+            super().draw_grid()
+        elif pixels >= ARROW_PIXELS :
+            self.note.config(text="")
+            self.draw_image(g.size * pixels, 1, self.arrow_image(pixels))
+        else :
+            # Too few pixels per cell for an arrow to be told apart
+            self.note.config(text="Cells too small for arrows, showing the values only")
+            super().draw_grid()
 
-                x = self.controller.p.arrow_grid()[j][i]
-                self.canvas.create_text(text_x, text_y, text=f"{x}", fill="black", font=("Helvetica", int(cell_size / 4)))
+class ValueFunction(GridCanvas) :
+    font_ratio = 5
 
-class ValueFunction(tk.Frame) :
     def __init__(self, parent, controller) :
         super().__init__(parent)
         self.controller = controller
@@ -209,36 +497,29 @@ class ValueFunction(tk.Frame) :
                   command=lambda: controller.show_frame(Menu)).pack()
         tk.Button(self, text="Arrow Gradient",
                   command=lambda: controller.show_frame(ArrowGradient)).pack()
-        
-        self.width = 800
-        self.canvas = tk.Canvas(self, width=self.width, height=self.width)
-        self.canvas.pack(padx=50)
-    
+        tk.Button(self, text="Cancel", command=controller.cancel).pack()
+        self.create_canvas()
+
+    def texts(self) :
+        return self.controller.p.value_fct()
+
+    def heatmap(self) :
+        size = self.controller.grid.size
+        values = np.full((size, size), np.nan)
+        for (x, y), value in self.controller.p.value_function.items() :
+            values[y, x] = value
+        return self.value_colors(values)
+
+    def animate(self, values) :
+        """Draws one frame of a running solve from a [y, x] value array"""
+        size = self.controller.grid.size
+        self.draw_image(size, self.width / (size * self.scale), self.value_colors(values))
+
     def draw_grid(self):
         if not hasattr(self.controller, "p") or self.controller.p is None:
             print("Policy not yet computed.")
             return
-        self.canvas.delete("all")
-        g = self.controller.grid
-        cell_size = self.width / (g.size * 1.3)
-        for i in range(g.size):
-            for j in range(g.size):
-                cell = g[i, j]
-                color = self.controller.get_color(cell)
-                x0 = i * cell_size
-                y0 = j * cell_size
-                x1 = (i + 1) * cell_size
-                y1 = (j + 1) * cell_size
-
-                self.canvas.create_rectangle(x0, y0, x1, y1, fill=color, outline="gray")
-
-                text_x = (x0 + x1) / 2
-                text_y = (y0 + y1) / 2
-
-                # For example, display cell coordinates or any property
-                x = self.controller.p.value_fct()[j][i]
-                # x = f"{x:.1f}" if isinstance(x, float) else str(x)
-                self.canvas.create_text(text_x, text_y, text=f"{x}", fill="black", font=("Helvetica", int(cell_size / 5)))
+        super().draw_grid()
 
 if __name__ == "__main__" :
     app = Visualizer()
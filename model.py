@@ -1,41 +1,277 @@
 import copy
-from cell import Obstacle, End
+import numpy as np
+from collections.abc import Mapping, Sequence
+from cell import Obstacle, End, DIRECTIONS
+
+COMPACT_ARRAYS = ["action_ptr", "action_slot", "action_successor", "transition_ptr", "transition_successor", "transition_code"]
+# The position of direction slot k among the neighbors of a cell with neighbor mask m, RANKS[m][k]
+SLOTS = {(-1, 0) : 0, (0, -1) : 1, (1, 0) : 2, (0, 1) : 3}
+RANKS = [[bin(mask & ((1 << k) - 1)).count("1") for k in range(len(DIRECTIONS))] for mask in range(1 << len(DIRECTIONS))]
+
+def index_dtype(limit) :
+    """Returns the narrowest unsigned dtype holding the indices 0 to limit"""
+    return np.uint16 if limit < 2 ** 16 else np.uint32 if limit < 2 ** 32 else np.uint64
 
 class Model :
-    def __init__(self, grid, deterministic, epsilon = 0.4):
+    def __init__(self, grid, deterministic, epsilon = 0.4, compact = False):
         """Constructs either a deterministic or stochastic model of the environment
 
         Args:
             grid (Grid): The grid of states
             deterministic (boolean): Whether the model is stochastic or deterministic
             epsilon (float, optional): The probability of misfiring. Defaults to 0.3.
+            compact (boolean, optional): Whether to store the transitions as flat index arrays
+                instead of nested dicts. Defaults to False.
         """
         self.grid = grid
         self.deterministic = deterministic
         self.epsilon = epsilon
+        self.compact = compact
+        if self.compact :
+            self.states = CompactStates(self.grid.size)
+            self.build_compact()
+            self.state_action_pairs = CompactActions(self)
+            self.transitions = CompactTransitions(self)
+            return
         self.states = [(i, j) for i in range(self.grid.size) for j in range(self.grid.size)]
-        self.state_action_pairs = {state : [action for action in self.grid[state].neighbors.values()] for state in self.states}
+        self.state_action_pairs = {}
         self.transitions = {}
+        for state in self.states :
+            self.add_transitions(state)
+
+    def add_transitions(self, state) :
+        """Fills the actions and transition dicts of one state from the grid"""
+        self.state_action_pairs[state] = [action for action in self.grid[state].neighbors.values()]
+        if self.deterministic :
+            self.transitions |= {(state, action) : {action : 1} for action in self.state_action_pairs[state]}
+            return
+        if any([isinstance(self.grid[state], x) for x in [Obstacle, End]]) :
+            return
+        for action in self.state_action_pairs[state] :
+            others = copy.deepcopy(self.state_action_pairs[state])
+            others.pop(others.index(action))
+            if len(others) == 0 :
+                self.transitions[(state, action)] = {action : 1}
+            else :
+                self.transitions[(state, action)] = {action : 1 - self.epsilon} | {other : self.epsilon / len(others) for other in others}
+
+    def update(self, cells) :
+        """Brings the transitions of the given cells up to date after edits of the grid
+
+        Dict models only replace the entries of those cells. Compact models rebuild their
+        arrays, which is a few vectorized passes, since the CSR offsets of every later state
+        would shift anyway.
+
+        Args:
+            cells (list): The coordinates returned by Grid.set_cell
+        """
+        if self.compact :
+            self.build_compact()
+            return
+        for state in cells :
+            for action in self.state_action_pairs.get(state, []) :
+                self.transitions.pop((state, action), None)
+            self.add_transitions(state)
+
+    def build_compact(self) :
+        """Builds the CSR-style transition arrays
+
+        States are flat indices y * size + x. The actions of state s are the pairs
+        action_ptr[s] to action_ptr[s + 1], each with its direction slot and intended
+        successor. The outcomes of pair p are the entries transition_ptr[p] to
+        transition_ptr[p + 1], the intended successor first and the misfires after it.
+        Every entry stores the code of its probability in probabilities: 0 for certain
+        moves, 1 for the intended move and 1 + k for a misfire shared by k other moves.
+        Indices use the narrowest unsigned dtype that holds them.
+        """
+        size = self.grid.size
+        cells = size ** 2
+        bits = (self.grid.neighbor_mask.reshape(-1, 1) >> np.arange(len(DIRECTIONS), dtype=np.uint8)) & 1
+        counts = bits.sum(axis=1, dtype=np.int64)
+        active = ~np.isin(self.grid.types.ravel(), [Obstacle.kind, End.kind])
+
+        action_ptr = np.concatenate([[0], np.cumsum(counts)])
+        states, slots = np.nonzero(bits)
+        self.action_ptr = action_ptr.astype(index_dtype(action_ptr[-1]))
+        self.action_slot = slots.astype(np.int8)
+        action_successor = states + np.array([-1, -size, 1, size])[slots]
+        self.action_successor = action_successor.astype(index_dtype(cells))
+
+        pair_state = np.repeat(np.arange(cells), counts)
+        pair_position = np.arange(len(pair_state)) - action_ptr[pair_state]
+        pair_count = counts[pair_state]
         if self.deterministic :
-            self.transitions = {(state, action) : {action : 1} for state in self.states for action in self.grid[state].neighbors.values()} 
+            outcomes = np.ones(len(pair_state), dtype=np.int64)
         else :
-            for state in self.states :
-                if any([isinstance(self.grid[state], x) for x in [Obstacle, End]]) :
-                    continue
-                for action in self.state_action_pairs[state] :
-                    others = copy.deepcopy(self.state_action_pairs[state])
-                    others.pop(others.index(action))
-                    if len(others) == 0 : 
-                        self.transitions[(state, action)] = {action : 1}
-                    else :
-                        self.transitions[(state, action)] = {action : 1 - self.epsilon} | {other : self.epsilon / len(others) for other in others}
+            outcomes = np.where(active[pair_state], pair_count, 0)
+        transition_ptr = np.concatenate([[0], np.cumsum(outcomes)])
+        self.transition_ptr = transition_ptr.astype(index_dtype(transition_ptr[-1]))
+
+        entry_pair = np.repeat(np.arange(len(pair_state)), outcomes)
+        entry_rank = np.arange(len(entry_pair)) - transition_ptr[entry_pair]
+        # The intended action comes first, followed by the other actions in neighbor order
+        position = np.where(entry_rank == 0, pair_position[entry_pair], entry_rank - 1 + (entry_rank - 1 >= pair_position[entry_pair]))
+        self.transition_successor = self.action_successor[action_ptr[pair_state[entry_pair]] + position]
+        others = pair_count[entry_pair] - 1
+        if self.deterministic :
+            self.transition_code = np.zeros(len(entry_pair), dtype=np.uint8)
+        else :
+            self.transition_code = np.where(others == 0, 0, np.where(entry_rank == 0, 1, 1 + others)).astype(np.uint8)
+        self.index_views()
+
+    def index_views(self) :
+        """Prepares the probability of every code and the memoryviews read by the Mapping views"""
+        # The same arithmetic as the dict model, so both give identical probabilities
+        self.probabilities = [1.0, 1 - self.epsilon] + [self.epsilon / others for others in range(1, len(DIRECTIONS))]
+        # Memoryviews read single entries and slices as Python numbers, much faster than the arrays
+        self.views = {name : memoryview(np.ascontiguousarray(getattr(self, name))) for name in COMPACT_ARRAYS}
+        self.views["neighbor_mask"] = memoryview(np.ascontiguousarray(self.grid.neighbor_mask).ravel())
+
+    @property
+    def transition_probability(self) :
+        """The probability of every entry, expanded from the codes"""
+        return np.array(self.probabilities)[self.transition_code]
+
+    @classmethod
+    def from_arrays(cls, grid, deterministic, epsilon, arrays) :
+        """Rebuilds a compact model from the arrays returned by to_arrays, without copying them"""
+        model = cls.__new__(cls)
+        model.grid, model.deterministic, model.epsilon, model.compact = grid, deterministic, epsilon, True
+        model.states = CompactStates(grid.size)
+        for name in COMPACT_ARRAYS :
+            setattr(model, name, arrays[name])
+        model.index_views()
+        model.state_action_pairs = CompactActions(model)
+        model.transitions = CompactTransitions(model)
+        return model
+
+    def to_arrays(self) :
+        if not self.compact :
+            raise ValueError("Only compact models can be exported as arrays")
+        return {name : getattr(self, name) for name in COMPACT_ARRAYS}
+
+    def index(self, state) :
+        return state[1] * self.grid.size + state[0]
+
+    def coordinates(self, index) :
+        return (int(index) % self.grid.size, int(index) // self.grid.size)
+
+    def pair(self, s, a) :
+        size, views = self.grid.size, self.views
+        state = s[1] * size + s[0]
+        slot = SLOTS.get((a[0] - s[0], a[1] - s[1]))
+        mask = views["neighbor_mask"][state]
+        if slot is None or not mask >> slot & 1 :
+            raise KeyError((s, a))
+        p = views["action_ptr"][state] + RANKS[mask][slot]
+        if views["transition_ptr"][p] == views["transition_ptr"][p + 1] :
+            raise KeyError((s, a))
+        return p
 
     def conditional_probability(self, s, a, true_action) :
-        return self.transitions[(s, a)][true_action]   
-    
+        if not self.compact :
+            return self.transitions[(s, a)][true_action]
+        p, target, views = self.pair(s, a), self.index(true_action), self.views
+        for entry in range(views["transition_ptr"][p], views["transition_ptr"][p + 1]) :
+            if views["transition_successor"][entry] == target :
+                return self.probabilities[views["transition_code"][entry]]
+        raise KeyError(true_action)
+
+    def transition_arrays(self) :
+        """Returns every transition as flat arrays (state, action slot, successor, probability)
+
+        The rows are ordered by flat state index, then by action, then by outcome in the
+        same order as the nested transition dicts.
+        """
+        if self.compact :
+            pair_state = np.repeat(np.arange(self.grid.size ** 2, dtype=np.int32), np.diff(self.action_ptr))
+            entry_pair = np.repeat(np.arange(len(pair_state), dtype=np.int32), np.diff(self.transition_ptr))
+            return pair_state[entry_pair], self.action_slot[entry_pair], self.transition_successor, self.transition_probability
+        states, slots, successors, probabilities = [], [], [], []
+        for state in sorted(self.states, key=self.index) :
+            directions = {coord : DIRECTIONS.index(direction) for direction, coord in self.grid[state].neighbors.items()}
+            for action in self.state_action_pairs[state] :
+                if (state, action) not in self.transitions :
+                    continue
+                for true_action, probability in self.transitions[(state, action)].items() :
+                    states.append(self.index(state))
+                    slots.append(directions[action])
+                    successors.append(self.index(true_action))
+                    probabilities.append(probability)
+        return np.array(states, dtype=np.int32), np.array(slots, dtype=np.int8), np.array(successors, dtype=np.int32), np.array(probabilities, dtype=float)
+
+    def nbytes(self) :
+        if not self.compact :
+            return None
+        return sum(getattr(self, name).nbytes for name in COMPACT_ARRAYS)
+
     def __repr__(self) :
         result = ""
         for trans in self.transitions.items() :
             result += f"{trans}\n"
         return result
 
+class CompactStates(Sequence) :
+    """Read-only view of the coordinates of every cell, in the order of the states list of a dict model"""
+    def __init__(self, size) :
+        self.size = size
+
+    def __getitem__(self, k) :
+        if isinstance(k, slice) :
+            return [self[i] for i in range(*k.indices(len(self)))]
+        if k < 0 :
+            k += len(self)
+        if not 0 <= k < len(self) :
+            raise IndexError("State index out of range")
+        return (k // self.size, k % self.size)
+
+    def __iter__(self) :
+        return ((i, j) for i in range(self.size) for j in range(self.size))
+
+    def __len__(self) :
+        return self.size ** 2
+
+class CompactActions(Mapping) :
+    """Read-only view of a compact model with the state_action_pairs dict API"""
+    def __init__(self, model) :
+        self.model = model
+
+    def __getitem__(self, state) :
+        model, size = self.model, self.model.grid.size
+        views = model.views
+        s = model.index(state)
+        return [(x % size, x // size) for x in views["action_successor"][views["action_ptr"][s]:views["action_ptr"][s + 1]].tolist()]
+
+    def __iter__(self) :
+        return iter(self.model.states)
+
+    def __len__(self) :
+        return len(self.model.states)
+
+class CompactTransitions(Mapping) :
+    """Read-only view of a compact model with the transitions dict API"""
+    def __init__(self, model) :
+        self.model = model
+
+    def __getitem__(self, key) :
+        model, size = self.model, self.model.grid.size
+        p = model.pair(*key)
+        views, probabilities = model.views, model.probabilities
+        start, end = views["transition_ptr"][p], views["transition_ptr"][p + 1]
+        return {(t % size, t // size) : probabilities[c] for t, c in zip(views["transition_successor"][start:end].tolist(), views["transition_code"][start:end].tolist())}
+
+    def __iter__(self) :
+        for state in self.model.states :
+            for action in self.model.state_action_pairs[state] :
+                if (state, action) in self :
+                    yield (state, action)
+
+    def __contains__(self, key) :
+        try :
+            self.model.pair(*key)
+        except KeyError :
+            return False
+        return True
+
+    def __len__(self) :
+        return int(np.count_nonzero(np.diff(self.model.transition_ptr.astype(np.int64))))
@@ -0,0 +1,169 @@
+import multiprocessing, weakref
+import numpy as np
+from multiprocessing import shared_memory
+from engine import ArrayEngine
+
+# Commands written to the control array before the workers are released
+STOP, VALUE, POLICY = 0, 1, 2
+SHARED = ["rewards", "weights", "outcomes", "successors", "valid", "states", "buffers", "pi", "changes", "control"]
+
+def attach(specs) :
+    """Maps the shared arrays described by specs, returning the memories and the arrays"""
+    memories, arrays = [], {}
+    for name, (memory_name, shape, dtype) in specs.items() :
+        memory = shared_memory.SharedMemory(name=memory_name)
+        memories.append(memory)
+        arrays[name] = np.ndarray(shape, dtype, buffer=memory.buf)
+    return memories, arrays
+
+def work(specs, rows, barrier) :
+    """Backs up one stripe of states per sweep until told to stop"""
+    memories, arrays = attach(specs)
+    # A bare engine over the shared arrays, so the backups are the very same code
+    engine = ArrayEngine.__new__(ArrayEngine)
+    for name in ["rewards", "weights", "outcomes", "successors", "valid"] :
+        setattr(engine, name, arrays[name])
+    control, changes, states = arrays["control"], arrays["changes"], arrays["states"][rows]
+    try :
+        while True :
+            barrier.wait()
+            command, current = control
+            if command == STOP :
+                break
+            engine.values = arrays["buffers"][current]
+            old = engine.values[states]
+            new = engine.backup(rows) if command == VALUE else engine.evaluation_backup(arrays["pi"], rows)
+            arrays["buffers"][1 - current][states] = new
+            with np.errstate(invalid="ignore") :
+                changes[rows] = np.where(new == old, 0, new - old) ** 2
+            barrier.wait()
+    finally :
+        del engine, arrays, states, control, changes
+        for memory in memories :
+            memory.close()
+
+def shutdown(memories, processes, barrier) :
+    control = np.ndarray(2, np.int64, buffer=memories[SHARED.index("control")].buf)
+    control[0] = STOP
+    del control
+    if all(process.is_alive() for process in processes) :
+        barrier.wait(timeout=5)
+    for process in processes :
+        process.join(timeout=5)
+        if process.is_alive() :
+            process.terminate()
+    for memory in memories :
+        try :
+            memory.close()
+        except BufferError :
+            # Arrays of the engine still map it, the mapping goes away with them
+            pass
+        memory.unlink()
+
+class ParallelEngine(ArrayEngine) :
+    def __init__(self, model, workers = None) :
+        """An ArrayEngine whose synchronous sweeps run on a pool of processes
+
+        The workers start with the first synchronous sweep, when the arrays of the engine and
+        two value buffers move into shared memory, and run until close, after which the next
+        synchronous sweep starts them again. Every worker owns a stripe of grid rows and
+        writes the backups of its states into the buffer not being read, and a barrier
+        separates the sweeps, after which the buffers swap. The backups and the residual are
+        computed exactly like ArrayEngine, so the results match it bit for bit. Asynchronous
+        sweeps run in the calling process and never start the workers.
+
+        Args:
+            model (Model): The model of the environment to back up
+            workers (int, optional): The number of worker processes. Defaults to the CPU count.
+        """
+        super().__init__(model)
+        workers = workers or multiprocessing.cpu_count()
+        self.finalizer = None
+
+        # Stripes of whole grid rows with about the same number of states each
+        ys = self.states // self.size
+        counts = np.cumsum(np.bincount(ys, minlength=self.size))
+        cuts = np.unique(np.concatenate([[0], np.searchsorted(counts, np.linspace(0, counts[-1], workers + 1)[1:-1]) + 1, [self.size]]))
+        stripes = [np.flatnonzero((ys >= low) & (ys < high)) for low, high in zip(cuts[:-1], cuts[1:])]
+        self.stripes = [stripe for stripe in stripes if len(stripe)]
+
+    @property
+    def running(self) :
+        return self.finalizer is not None and self.finalizer.alive
+
+    def start(self) :
+        """Moves the arrays into shared memory and starts the workers, unless they are running"""
+        if self.running :
+            return
+        self.memories, specs = [], {}
+        arrays = {name : getattr(self, name) for name in ["rewards", "weights", "outcomes", "successors", "valid", "states"]}
+        arrays |= {"buffers" : np.stack([self.values, self.values]), "pi" : np.zeros(self.weights.shape),
+                   "changes" : np.zeros(len(self.states)), "control" : np.zeros(2, dtype=np.int64)}
+        for name in SHARED :
+            memory = shared_memory.SharedMemory(create=True, size=max(arrays[name].nbytes, 1))
+            shared = np.ndarray(arrays[name].shape, arrays[name].dtype, buffer=memory.buf)
+            shared[...] = arrays[name]
+            self.memories.append(memory)
+            specs[name] = (memory.name, shared.shape, shared.dtype.str)
+            setattr(self, name, shared)
+        self.current = 0
+        self.values = self.buffers[0]
+
+        self.barrier = multiprocessing.Barrier(len(self.stripes) + 1)
+        self.processes = [multiprocessing.Process(target=work, args=(specs, stripe, self.barrier), daemon=True) for stripe in self.stripes]
+        for process in self.processes :
+            process.start()
+        self.finalizer = weakref.finalize(self, shutdown, self.memories, self.processes, self.barrier)
+
+    def close(self) :
+        """Stops the workers and releases the shared memory, keeping private copies of the arrays"""
+        if not self.running :
+            return
+        for name in SHARED :
+            setattr(self, name, getattr(self, name).copy())
+        self.values = self.buffers[self.current]
+        self.finalizer()
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *exc_info) :
+        self.close()
+
+    def sample_rewards(self, rng) :
+        # The workers read the shared array, so the draw is written into it
+        self.rewards[...] = rng.normal(self.means, self.stds)
+
+    def run(self, command) :
+        """Lets the workers run one sweep and swaps the buffers, returning the sum of squared changes"""
+        # Cells outside the stripes keep their value in both buffers
+        self.buffers[1 - self.current][self.terminal] = self.values[self.terminal]
+        self.control[:] = command, self.current
+        self.barrier.wait()
+        self.barrier.wait()
+        self.current = 1 - self.current
+        self.values = self.buffers[self.current]
+        return float(np.sum(self.changes))
+
+    def value_sweep(self, synchronous) :
+        if not synchronous :
+            return super().value_sweep(synchronous)
+        self.start()
+        total = self.run(VALUE)
+        total += self.assign(self.terminal, 100)
+        return float(np.sqrt(total))
+
+    def policy_sweep(self, pi, synchronous) :
+        if not synchronous :
+            return super().policy_sweep(pi, synchronous)
+        self.start()
+        portals = list(self.portals)
+        starts = self.values[portals]
+        self.pi[...] = pi
+        total = self.run(POLICY)
+        total += self.assign(self.terminal, 100)
+
+        computed = self.values[portals]
+        self.values[portals] = computed[::-1]
+        total += self.squares(computed[::-1], starts) - self.squares(computed, starts)
+        return float(np.sqrt(max(total, 0)))
@@ -1,37 +1,150 @@
-import numpy as np, copy 
+import numpy as np
 from cell import *
 from grid import Grid
-import matplotlib.pyplot as plt
 from model import Model
-import math
+from engine import ArrayEngine
+from parallel import ParallelEngine
+import math, heapq, time, warnings
 
+from collections import namedtuple
+from collections.abc import Mapping
 from enum import Enum
 
+# The values are a (size, size) view indexed [y, x] with NaN where there is no state, and
+# changed holds the flat indices y * size + x whose value changed during the epoch
+Snapshot = namedtuple("Snapshot", ["epoch", "values", "changed", "residual"])
+
 class Direction(Enum) :
     RIGHT = '→' 
     UP = '↑' 
     DOWN = '↓'
     LEFT = '←'
 
+class CompactPolicy(Mapping) :
+    def __init__(self, grid) :
+        """A policy stored as one int8 DIRECTIONS slot per cell, with the policy dict API
+
+        actions is indexed [y, x] and holds -1 where a state has no single action. Those
+        states follow probabilities, the (size, size, 4) matrix of the initial uniform
+        policy, which is dropped by settle once every state has an action. Reading an entry
+        builds its neighbor dict on the fly.
+        """
+        self.grid = grid
+        self.active = ~np.isin(grid.types, [End.kind, Obstacle.kind])
+        self.bits = ((grid.neighbor_mask[..., None] >> np.arange(len(DIRECTIONS), dtype=np.uint8)) & 1).astype(bool)
+        counts = self.bits.sum(axis=2)
+        self.probabilities = np.where(self.active[..., None], self.bits / np.maximum(counts, 1)[..., None], 0)
+        # With a single neighbor the uniform policy is already deterministic
+        self.actions = np.where(self.active & (counts == 1), self.bits.argmax(axis=2), -1).astype(np.int8)
+
+    def __getitem__(self, state) :
+        x, y = state
+        if not self.active[y, x] :
+            raise KeyError(state)
+        action = self.actions[y, x]
+        slots = [(k, (x + dx, y + dy)) for k, (dx, dy) in enumerate(OFFSETS) if self.bits[y, x, k]]
+        if action >= 0 :
+            return {neighbor : int(k == action) for k, neighbor in slots}
+        return {neighbor : float(self.probabilities[y, x, k]) for k, neighbor in slots}
+
+    def __setitem__(self, state, probabilities) :
+        x, y = state
+        chosen = [neighbor for neighbor, probability in probabilities.items() if probability == 1]
+        if chosen :
+            self.actions[y, x] = OFFSETS.index((chosen[0][0] - x, chosen[0][1] - y))
+            return
+        if self.probabilities is None :
+            self.probabilities = np.zeros(self.bits.shape)
+        self.probabilities[y, x] = 0
+        for (i, j), probability in probabilities.items() :
+            self.probabilities[y, x, OFFSETS.index((i - x, j - y))] = probability
+        self.actions[y, x] = -1
+
+    def __iter__(self) :
+        xs, ys = np.nonzero(self.active.T)
+        return zip(xs.tolist(), ys.tolist())
+
+    def __len__(self) :
+        return int(np.count_nonzero(self.active))
+
+    def settle(self) :
+        """Drops the probability matrix once every state has an action"""
+        if self.probabilities is not None and not np.any(self.actions[self.active] < 0) :
+            self.probabilities = None
+
+    def probability_array(self, states) :
+        """Returns the (len(states), 4) action probabilities of flat state indices"""
+        ys, xs = np.divmod(states, self.grid.size)
+        result = np.zeros((len(states), len(DIRECTIONS))) if self.probabilities is None else self.probabilities[ys, xs]
+        actions = self.actions[ys, xs]
+        chosen = np.flatnonzero(actions >= 0)
+        result[chosen] = 0
+        result[chosen, actions[chosen]] = 1
+        return result
+
 class PolicyAlgorithm :
-    def __init__(self, grid, model, synchronous = False, epochs = 1000, tolerance = 0.1) :
+    def __init__(self, grid, model, synchronous = False, epochs = 1000, tolerance = 0.1, rewards = "expected", seed = None, compact_policy = False) :
+        """Shared state of the planning algorithms
+
+        Args:
+            rewards (str, optional): "expected" to back up the mean reward of every cell, or
+                "sampled" to draw the rewards of stochastic cells anew before every sweep.
+                Defaults to "expected".
+            seed (int, optional): The seed of the generator drawing sampled rewards. Defaults to None.
+            compact_policy (boolean, optional): Whether the policy is a CompactPolicy action array
+                instead of a dict of neighbor dicts. Defaults to False.
+        """
+        if rewards not in ("expected", "sampled") :
+            raise ValueError(f"Unknown rewards {rewards}")
         self.grid = grid
         self.model = model
         self.epochs = epochs
         self.tolerance = tolerance
-        self.policy = self.create_empty_policy(zeros = False)
+        self.compact_policy = compact_policy
+        self.policy = CompactPolicy(grid) if compact_policy else self.create_empty_policy(zeros = False)
         self.value_function = self.create_empty_value_function()
         self.value_function[self.grid.end] = 0
         self.synchronous = synchronous
+        self.engine = None
+        self.backups = 0
+        self.residual = math.inf
+        self.converged = False
+        self.policy_changed = True
+        self.policy_changes = 0
+        self.observers = []
+        self.phase_times = {}
+        self.cancelled = False
+        self.rewards = rewards
+        self.rng = np.random.default_rng(seed)
+        self.reward = self.expected_rewards()
+
+    def add_observer(self, observer) :
+        """Registers a callable that receives every event dict emitted while deriving the policy"""
+        self.observers.append(observer)
+
+    def cancel(self) :
+        """Asks derive_policy to stop before its next epoch, callable from another thread"""
+        self.cancelled = True
+
+    def emit(self, event, **data) :
+        data = {"event" : event, "algorithm" : type(self).__name__} | data
+        for observer in self.observers :
+            observer(data)
+
+    def timed(self, phase, function) :
+        start = time.perf_counter()
+        result = function()
+        self.phase_times[phase] = self.phase_times.get(phase, 0) + time.perf_counter() - start
+        return result
 
     def create_empty_policy(self, zeros = False) :
         new_policy = {}
         for i in range(self.grid.size) :
             for j in range(self.grid.size) :
-                if any([isinstance(self.grid[i, j], x) for x in [End, Obstacle]]) :
+                if self.grid.types[j, i] in (End.kind, Obstacle.kind) :
                     continue
-                neighbors = self.grid[(i, j)].neighbors.values()
-                probability = 0 if zeros else 1 / len(self.grid[(i, j)].neighbors)
+                neighbors = self.grid.neighbor_coordinates(i, j)
+                probability = 0 if zeros else 1 / len(neighbors)
                 new_policy[(i, j)] = {neighbor : probability for neighbor in neighbors}
         return new_policy
 
@@ -39,14 +152,87 @@ class PolicyAlgorithm :
         new_function = {}
         for i in range(self.grid.size) :
             for j in range(self.grid.size) :
-                if any([isinstance(self.grid[i, j], x) for x in [End, Obstacle]]) :
+                if self.grid.types[j, i] in (End.kind, Obstacle.kind) :
                     continue
                 new_function[(i, j)] = 0
         return new_function
 
+    def expected_rewards(self) :
+        """Returns a dict of the mean reward of every state, and keeps the arrays sampling draws from"""
+        self.reward_states = list(self.value_function)
+        xs, ys = np.array(self.reward_states).T
+        self.reward_means = self.grid.reward_mean[ys, xs].astype(float)
+        self.reward_stds = np.where(self.grid.deterministic[ys, xs], 0, self.grid.reward_std[ys, xs])
+        return dict(zip(self.reward_states, self.reward_means.tolist()))
+
+    def refresh_rewards(self) :
+        """Draws the rewards of the next sweep in one batch when they are sampled"""
+        if self.rewards != "sampled" :
+            return
+        if self.engine is not None :
+            self.engine.sample_rewards(self.rng)
+        else :
+            self.reward = dict(zip(self.reward_states, self.rng.normal(self.reward_means, self.reward_stds).tolist()))
+
+    def create_engine(self) :
+        """Returns the array engine the algorithm backs up with, or None when it works on the dicts"""
+        return None
+
+    def sync_states(self, cells) :
+        """Matches the dicts, rewards and engine to the grid after cells were edited
+
+        Every state keeps its value and policy, except that new states start at 0 and the
+        edited cells get a uniform policy over their new neighbors.
+        """
+        values, policy, edited = self.value_function, self.policy, set(cells)
+        self.value_function = {state : values.get(state, 0) for state in self.create_empty_value_function()}
+        self.value_function[self.grid.end] = values[self.grid.end]
+        if self.compact_policy :
+            self.policy = CompactPolicy(self.grid)
+            kept = self.policy.active & (policy.actions >= 0)
+            for x, y in edited :
+                kept[y, x] = False
+            self.policy.actions[kept] = policy.actions[kept]
+        else :
+            self.policy = {state : policy[state] if state in policy and state not in edited else probabilities
+                           for state, probabilities in self.create_empty_policy().items()}
+        self.reward = self.expected_rewards()
+        if self.engine is not None :
+            if isinstance(self.engine, ParallelEngine) :
+                self.engine.close()
+            self.engine = self.create_engine()
+            self.engine.load(self.value_function)
+
+    def resolve(self, cells) :
+        """Solves the grid again after cells were edited, warm-started from the current solution
+
+        Args:
+            cells (list): The coordinates returned by Grid.set_cell, once Model.update was called with them
+
+        Returns:
+            numpy.ndarray: The residuals of the new run
+        """
+        self.sync_states(cells)
+        self.cancelled = False
+        self.policy_changed = True
+        return self.derive_policy()
+
     def policy_convergence(self, old_policy) :
         return self.policy == old_policy
     
+    def tracked_states(self) :
+        """Returns the current values of the states a sweep overwrites after its main loop"""
+        return {key : self.value_function[key] for key in [self.grid.end, self.grid.portal_top, self.grid.portal_bottom] if key in self.value_function}
+
+    def squared_change(self, new, old) :
+        return 0 if new == old else (new - old) ** 2
+
+    def sweep_residual(self, total, values, starts) :
+        """Completes the running squared change of a sweep with its tracked states, as an L2 norm"""
+        total += sum(self.squared_change(values[key], value) for key, value in starts.items())
+        self.residual = math.sqrt(total)
+        return self.residual
+
     def value_function_convergence(self, old_value_function) :
         if len(old_value_function) != len(self.value_function) :
             raise ValueError("Value functions do not have the same size")
@@ -54,6 +240,8 @@ class PolicyAlgorithm :
             return 0
         total = 0
         for key, value in self.value_function.items() :
+            if value == old_value_function[key] :
+                continue
             total += abs(value - old_value_function[key]) ** 2
         return math.sqrt(total) 
     
@@ -106,13 +294,18 @@ class PolicyAlgorithm :
         return result
     
     def find_direction(self, key) :
-        policy = self.policy[key]
         i, j = key
         y, x = 0, 0
-        for coord in policy.keys() :
-            if policy[coord] == 1 :
-                x, y = coord
-                break
+        if self.compact_policy :
+            action = self.policy.actions[j, i]
+            if action >= 0 :
+                x, y = i + OFFSETS[action][0], j + OFFSETS[action][1]
+        else :
+            policy = self.policy[key]
+            for coord in policy.keys() :
+                if policy[coord] == 1 :
+                    x, y = coord
+                    break
         if x - i > 0 :
             return Direction.RIGHT.value
         elif x - i < 0 :
@@ -123,45 +316,135 @@ class PolicyAlgorithm :
             return Direction.UP.value
 
     def derive_policy(self) :
-        diffs = []
-        for i in range(self.epochs) :
-            old_policy = copy.deepcopy(self.policy)
-            old_value_function = copy.deepcopy(self.value_function)
-
-            self.process()
+        """Runs epochs until convergence and returns the array of residuals
+
+        Every epoch emits an "epoch" event with its residual, policy changes, backups and the
+        wall time of each phase, and the end of the run emits "alternating" and "converged"
+        events carrying the messages that used to be printed. A run that uses up all its
+        epochs emits an "unconverged" event instead, issues a RuntimeWarning and leaves
+        converged False. A cancelled run emits a "cancelled" event and returns the residuals
+        so far, leaving the policy unimproved.
+        """
+        for _ in self.iterate(snapshots = False) :
+            pass
+        return np.array(self.diffs)
+
+    def iterate(self, snapshots = True) :
+        """Runs derive_policy step by step, yielding a Snapshot after every epoch
+
+        The snapshots share two value buffers that are swapped between epochs, so a snapshot
+        is only valid until the next one is requested and must be copied to be kept. Closing
+        the generator stops the run like cancel does. Without snapshots None is yielded. A
+        parallel engine is closed when the run ends, stopping its workers.
+        """
+        try :
+            self.diffs = diffs = []
+            buffers = None
+            for i in range(self.epochs) :
+                if self.cancelled :
+                    self.emit("cancelled", epoch=i, message="Cancelled")
+                    return
+                backups = self.backups
+                self.phase_times = {}
+                diff = self.process()
             
-            policy_converged = True
-            if isinstance(self, PolicyIteration) :
-                policy_converged = self.policy_convergence(old_policy)
-
-            diff = self.value_function_convergence(old_value_function)
-            diffs.append(diff)
-
-            alternating_policies = False
-            if len(diffs) > self.grid.size :
-                alternating_policies = all([abs(diff - diffs[-i-1]) < self.tolerance for i in range(self.grid.size)])
-
-            if policy_converged and (diff < self.tolerance or alternating_policies):
-                if alternating_policies :
-                    print("Alternating Policies")
-                if isinstance(self, ValueIteration) :
-                    self.policy_improvement()
-                if i % 10 == 1 :
-                    suffix = "st"
-                elif i % 10 == 2 :
-                    suffix = "nd"
-                elif i % 10 == 3 :
-                    suffix = "rd"
+                start = time.perf_counter()
+                policy_converged = True
+                if isinstance(self, PolicyIteration) :
+                    policy_converged = not self.policy_changed
+
+                diffs.append(diff)
+
+                alternating_policies = self.alternating(diffs)
+                self.phase_times["convergence"] = time.perf_counter() - start
+
+                self.emit("epoch", epoch=i, residual=float(diff), policy_changes=self.policy_changes if isinstance(self, PolicyIteration) else 0,
+                          backups=self.backups - backups, times=dict(self.phase_times))
+
+                if snapshots :
+                    if buffers is None :
+                        buffers = self.snapshot_buffers()
+                    buffers = buffers[::-1]
+                    yield self.snapshot(i, diff, *buffers)
                 else :
-                    suffix = "th"
-                print(f"Converged on {i}{suffix} iteration")
-                return np.array(diffs) 
-        print(f"Converged on 1000-th iteration")
-        if isinstance(self, ValueIteration) :
-            self.policy_improvement()
-        return np.array(diffs)
+                    yield None
+
+                if policy_converged and (self.settled(diff) or alternating_policies):
+                    if alternating_policies :
+                        self.emit("alternating", epoch=i, message="Alternating Policies")
+                    if isinstance(self, ValueIteration) :
+                        self.timed("improvement", self.policy_improvement)
+                    if i % 10 == 1 :
+                        suffix = "st"
+                    elif i % 10 == 2 :
+                        suffix = "nd"
+                    elif i % 10 == 3 :
+                        suffix = "rd"
+                    else :
+                        suffix = "th"
+                    self.converged = True
+                    self.emit("converged", epoch=i, residual=float(diff), backups=self.backups, message=f"Converged on {i}{suffix} iteration")
+                    return
+            if isinstance(self, ValueIteration) :
+                self.timed("improvement", self.policy_improvement)
+            residual = float(diffs[-1]) if diffs else math.inf
+            message = f"Stopped after {self.epochs} epochs without converging, residual {residual:.4g}"
+            self.emit("unconverged", epoch=self.epochs, residual=residual, backups=self.backups, message=message)
+            warnings.warn(message, RuntimeWarning)
+        finally :
+            # The workers of a parallel engine start again with the next synchronous sweep
+            if isinstance(self.engine, ParallelEngine) :
+                self.engine.close()
+
+    def settled(self, diff) :
+        """Whether the residual of an epoch is small enough to stop"""
+        return diff < self.tolerance
+
+    def alternating(self, diffs) :
+        """Whether the last grid.size residuals repeat, a sign of policies alternating forever"""
+        if len(diffs) <= self.grid.size :
+            return False
+        return all([abs(diffs[-1] - diffs[-i-1]) < self.tolerance for i in range(self.grid.size)])
+
+    def state_values(self) :
+        """Returns the flat indices and current values of the states as two arrays"""
+        size, count = self.grid.size, len(self.value_function)
+        indices = np.fromiter((y * size + x for x, y in self.value_function), dtype=np.int64, count=count)
+        return indices, np.fromiter(self.value_function.values(), dtype=float, count=count)
+
+    def snapshot_buffers(self) :
+        """Returns the two flat value buffers filled with the values before the first epoch"""
+        buffers = np.full((2, self.grid.size ** 2), np.nan)
+        indices, _ = self.state_values()
+        buffers[:, indices] = 0
+        buffers[:, self.grid.end[1] * self.grid.size + self.grid.end[0]] = 0
+        return buffers[0], buffers[1]
+
+    def snapshot(self, epoch, residual, previous, current) :
+        indices, values = self.state_values()
+        current[indices] = values
+        changed = indices[values != previous[indices]]
+        return Snapshot(epoch, current.reshape(self.grid.size, self.grid.size), changed, float(residual))
+
+    def solution_arrays(self) :
+        """Returns the values, indexed [y, x] with NaN where there is no state, and the
+        DIRECTIONS slot of the action taken in every state, -1 where there is none"""
+        values = np.full((self.grid.size, self.grid.size), np.nan)
+        actions = np.full((self.grid.size, self.grid.size), -1, dtype=np.int8)
+        for (x, y), value in self.value_function.items() :
+            values[y, x] = value
+        if self.compact_policy :
+            actions[self.policy.active] = self.policy.actions[self.policy.active]
+            return values, actions
+        for (x, y), probabilities in self.policy.items() :
+            for (i, j), probability in probabilities.items() :
+                if probability == 1 :
+                    actions[y, x] = OFFSETS.index((i - x, j - y))
+        return values, actions
 
     def convergence_analysis(self) :
+        # Imported here so solving never pays for loading matplotlib
+        import matplotlib.pyplot as plt
         diffs = self.derive_policy()
         x = np.arange(len(diffs))
         plt.scatter(x, diffs)
@@ -209,8 +492,29 @@ class PolicyAlgorithm :
             result.append(row)
         return result
     
+    def improve_actions(self) :
+        """Policy improvement on a CompactPolicy, picking the first best neighbor of every state at once"""
+        size, policy = self.grid.size, self.policy
+        indices, values = self.state_values()
+        table = np.full(size ** 2, -np.inf)
+        table[indices] = values
+        ys, xs = np.nonzero(policy.active)
+        bits = policy.bits[ys, xs]
+        neighbors = np.clip((ys * size + xs)[:, None] + np.array([-1, -size, 1, size]), 0, size ** 2 - 1)
+        candidates = np.where(bits, table[neighbors], -np.inf)
+        best = candidates.argmax(axis=1)
+        # When every neighbor is minus infinity the first accessible one is kept, like the dict version
+        best = np.where(bits[np.arange(len(best)), best], best, bits.argmax(axis=1)).astype(np.int8)
+        self.policy_changes = int(np.count_nonzero(policy.actions[ys, xs] != best))
+        policy.actions[ys, xs] = best
+        policy.settle()
+        self.policy_changed = self.policy_changes > 0
+
     def policy_improvement(self) :
+        if self.compact_policy :
+            return self.improve_actions()
         new_policy = self.create_empty_policy(zeros = True)
+        self.policy_changes = 0
         for base in self.value_function :
 
             if base == self.grid.end :
@@ -219,7 +523,7 @@ class PolicyAlgorithm :
             max_coord = None
 
             for neighbor in self.policy[base].keys() :
-                if not maximum :
+                if max_coord is None :
                     maximum = self.value_function[neighbor]
                     max_coord = neighbor
                     new_policy[base][neighbor] = 1
@@ -228,92 +532,406 @@ class PolicyAlgorithm :
                     new_policy[base][neighbor] = 1
                     maximum = self.value_function[neighbor]
                     max_coord = neighbor
+            if new_policy[base] != self.policy[base] :
+                self.policy_changes += 1
+        self.policy_changed = self.policy_changes > 0
         self.policy = new_policy  
 
 class PolicyIteration(PolicyAlgorithm) :
-    def __init__(self, grid, model, synchronous = True) -> None :
-        super().__init__(grid, model, synchronous)
+    def __init__(self, grid, model, synchronous = True, evaluation = "sweep", sweeps = 1, rewards = "expected", seed = None, compact_policy = False, engine = "dict", workers = None) -> None :
+        """Alternates policy evaluation and greedy policy improvement
+
+        Args:
+            evaluation (str, optional): "sweep" to run a fixed number of evaluation sweeps per
+                improvement, or "exact" to solve the linear system of the current policy on an
+                ArrayEngine. Exact evaluation has no sweeps, so synchronous does not apply to it
+                and sweeps must stay 1. Defaults to "sweep".
+            sweeps (int, optional): The number of evaluation sweeps per improvement. Values
+                above 1 give modified policy iteration, whose residual is the L2 change of the
+                values over all the sweeps of an epoch. Defaults to 1.
+            rewards (str, optional): "expected" or "sampled", see PolicyAlgorithm. Defaults to "expected".
+            seed (int, optional): The seed of the generator drawing sampled rewards. Defaults to None.
+            compact_policy (boolean, optional): Whether to store the policy as a CompactPolicy. Defaults to False.
+            engine (str, optional): "dict" to run the evaluation sweeps on the value function dict,
+                "numpy" to run them for every state at once with an ArrayEngine, or "parallel" to
+                split synchronous sweeps over worker processes with a ParallelEngine. The array
+                sweeps add up the outcomes of a move before weighting them, so their values can
+                differ from the dict sweeps by rounding, and ties between neighbors may then
+                break differently. Asynchronous array sweeps follow the checkerboard order of
+                ArrayEngine.policy_sweep. Exact evaluation always uses an ArrayEngine, so it
+                cannot be parallel. Defaults to "dict".
+            workers (int, optional): The number of processes of the parallel engine. Defaults to the CPU count.
+        """
+        super().__init__(grid, model, synchronous, rewards=rewards, seed=seed, compact_policy=compact_policy)
+        if evaluation not in ("sweep", "exact") :
+            raise ValueError(f"Unknown evaluation {evaluation}")
+        if engine not in ("dict", "numpy", "parallel") :
+            raise ValueError(f"Unknown engine {engine}")
+        if evaluation == "exact" and engine == "parallel" :
+            raise ValueError("Exact evaluation cannot run on the parallel engine")
+        if sweeps < 1 :
+            raise ValueError("Evaluation needs at least one sweep")
+        if evaluation == "exact" and sweeps != 1 :
+            raise ValueError("Exact evaluation does not run sweeps")
+        self.evaluation = evaluation
+        self.sweeps = sweeps
+        self.engine_name = engine
+        self.workers = workers
+        self.engine = self.create_engine()
+
+    def create_engine(self) :
+        if self.engine_name == "parallel" :
+            return ParallelEngine(self.model, self.workers)
+        if self.evaluation == "exact" or self.engine_name == "numpy" :
+            return ArrayEngine(self.model)
+        return None
 
     def process(self) :
-        if self.synchronous :
-            self.value_function = self.policy_eval_sync()
+        self.timed("evaluation", self.evaluate)
+        self.timed("improvement", self.policy_improvement)
+        return self.residual
+
+    def evaluate(self) :
+        if self.evaluation == "exact" :
+            self.refresh_rewards()
+            self.residual = self.engine.solve_policy(self.engine.policy_array(self.policy), self.tolerance)
+            self.backups += len(self.engine.states)
+            self.value_function = self.engine.value_function()
+        elif self.engine is not None :
+            pi = self.engine.policy_array(self.policy)
+            starts = self.engine.values.copy()
+            for _ in range(self.sweeps) :
+                self.refresh_rewards()
+                self.residual = self.engine.policy_sweep(pi, self.synchronous)
+                self.backups += len(self.engine.states)
+            if self.sweeps > 1 :
+                self.residual = math.sqrt(self.engine.squares(self.engine.values, starts))
+            self.value_function = self.engine.value_function()
         else :
-            self.policy_eval_async()
-
-        self.policy_improvement()
+            starts = dict(self.value_function) if self.sweeps > 1 else None
+            for _ in range(self.sweeps) :
+                self.refresh_rewards()
+                if self.synchronous :
+                    self.value_function = self.policy_eval_sync()
+                else :
+                    self.policy_eval_async()
+            if starts is not None :
+                # The residual of the whole evaluation phase, not of its last sweep
+                self.residual = self.value_function_convergence(starts)
 
     def policy_eval_sync(self) :
         new_function = self.create_empty_value_function()
+        starts = self.tracked_states()
+        total = 0
 
         for base in self.value_function :
             if base == self.grid.end :
                 continue
 
-            value = self.grid[base].get_reward()
-            for neighbor in self.policy[base].keys() :
-                for true_action in self.model.transitions[(base, neighbor)].keys() :
-                    value += self.policy[base][neighbor] * self.model.conditional_probability(base, neighbor, true_action) * self.value_function[neighbor]
+            value = self.reward[base]
+            probabilities = self.policy[base]
+            for neighbor, probability in probabilities.items() :
+                for conditional in self.model.transitions[(base, neighbor)].values() :
+                    value += probability * conditional * self.value_function[neighbor]
             new_function[base] = value
+            self.backups += 1
+            if base not in starts :
+                total += self.squared_change(value, self.value_function[base])
         new_function[self.grid.end] = 100
         new_function[self.grid.size - 1, 0], new_function[0, self.grid.size - 1] = new_function[0, self.grid.size - 1], new_function[self.grid.size - 1, 0] 
+        self.sweep_residual(total, new_function, starts)
         return new_function
 
     def policy_eval_async(self) :
+        starts = self.tracked_states()
+        total = 0
         for base in self.value_function :
             if base == self.grid.end :
                 continue
 
-            value = self.grid[base].get_reward()
+            value = self.reward[base]
+            probabilities = self.policy[base]
 
-            for neighbor in self.policy[base].keys() :
-                for true_action in self.model.transitions[(base, neighbor)].keys() :
+            for neighbor, probability in probabilities.items() :
+                for conditional in self.model.transitions[(base, neighbor)].values() :
 
-                    value += self.policy[base][neighbor] * self.model.conditional_probability(base, neighbor, true_action) * self.value_function[neighbor]
+                    value += probability * conditional * self.value_function[neighbor]
+            if base not in starts :
+                total += self.squared_change(value, self.value_function[base])
             self.value_function[base] = value
+            self.backups += 1
         self.value_function[self.grid.end] = 100
         self.value_function[self.grid.size - 1, 0], self.value_function[0, self.grid.size - 1] = self.value_function[0, self.grid.size - 1], self.value_function[self.grid.size - 1, 0]         
+        return self.sweep_residual(total, self.value_function, starts)
 
 class ValueIteration(PolicyAlgorithm) :
-    def __init__(self, grid, model, synchronous = False) -> None :
-        super().__init__(grid, model, synchronous)
+    def __init__(self, grid, model, synchronous = False, engine = "dict", prioritized = False, rewards = "expected", seed = None, workers = None, compact_policy = False) -> None :
+        """Repeats Bellman optimality backups until the value function converges
+
+        Args:
+            engine (str, optional): "dict" to back up the value function dict state by state,
+                "numpy" to back up every state at once with an ArrayEngine, or "parallel" to split
+                synchronous sweeps over worker processes with a ParallelEngine. The engines set the
+                states that cannot reach the End to minus infinity. Their asynchronous sweeps
+                start below the solution and back up the states by distance to the End, so they
+                settle in a few epochs but do not match the dict path epoch by epoch, only their
+                converged values do. Synchronous sweeps match it on the states reaching the End.
+                Defaults to "dict".
+            prioritized (boolean, optional): Whether asynchronous backups follow a priority queue
+                ordered by Bellman error (prioritized sweeping). Defaults to False.
+            rewards (str, optional): "expected" or "sampled", see PolicyAlgorithm. Defaults to "expected".
+            seed (int, optional): The seed of the generator drawing sampled rewards. Defaults to None.
+            workers (int, optional): The number of processes of the parallel engine. Defaults to the CPU count.
+            compact_policy (boolean, optional): Whether to store the policy as a CompactPolicy. Defaults to False.
+        """
+        super().__init__(grid, model, synchronous, rewards=rewards, seed=seed, compact_policy=compact_policy)
+        if prioritized and (synchronous or engine != "dict") :
+            raise ValueError("Prioritized sweeping requires the asynchronous dict engine")
+        if engine not in ("dict", "numpy", "parallel") :
+            raise ValueError(f"Unknown engine {engine}")
+        self.prioritized = prioritized
+        self.predecessors = None
+        self.engine_name = engine
+        self.workers = workers
+        self.engine = self.create_engine()
+
+    def create_engine(self) :
+        if self.engine_name == "numpy" :
+            engine = ArrayEngine(self.model)
+        elif self.engine_name == "parallel" :
+            engine = ParallelEngine(self.model, self.workers)
+        else :
+            return None
+        engine.mask_unreachable()
+        if not self.synchronous :
+            engine.start_below()
+        return engine
+
+    def sync_states(self, cells) :
+        super().sync_states(cells)
+        if self.engine is not None :
+            # The loaded values may have left states the edits cut off from the End
+            self.engine.mask_unreachable()
+
+    def resolve(self, cells) :
+        """Solves the grid again after cells were edited, warm-started from the current solution
+
+        With the dict engine only the edited cells and the states moving into them are
+        queued, and prioritized backups carry the changes outward from there until the
+        values settle, so cells far from the edits are only backed up if their value moves.
+        The engines re-run their sweeps from the previous values.
+        """
+        if self.engine is not None :
+            return super().resolve(cells)
+        self.sync_states(cells)
+        self.index_predecessors()
+        self.queue, self.priorities = [], {}
+        for cell in cells :
+            for base in [cell] + self.predecessors.get(cell, []) :
+                if base in self.value_function and base != self.grid.end :
+                    self.push(base)
+        self.cancelled = False
+        prioritized, self.prioritized = self.prioritized, True
+        try :
+            return self.derive_policy()
+        finally :
+            self.prioritized = prioritized
+
+    def policy_improvement(self) :
+        if self.engine is not None :
+            self.value_function = self.engine.value_function()
+        super().policy_improvement()
+
+    def state_values(self) :
+        if self.engine is None :
+            return super().state_values()
+        indices = np.append(self.engine.states, self.engine.terminal)
+        return indices, self.engine.values[indices]
+
+    def backup(self, base) :
+        coords = self.grid.neighbor_coordinates(*base)
+        reward = self.reward[base]
+        vals = {action : reward for action in coords}
+
+        for coord in coords :
+            for true_action, conditional in self.model.transitions[(base, tuple(coord))].items() :
+                vals[true_action] += conditional * self.value_function[true_action]
+        
+        self.backups += 1
+        return round(max(vals.values()), 3)
 
     def value_iter_sync(self) :
         new_value_function = self.create_empty_value_function()
+        starts = self.tracked_states()
+        total = 0
 
         for base in self.value_function :        
             if base == self.grid.end :
                 continue
-            coords = self.grid[base].neighbors.values()
-            vals = {action : self.grid[base].get_reward() for action in coords} 
-
-            for coord in coords :
-                for true_action in self.model.transitions[(base, tuple(coord))].keys() :
-                    vals[true_action] += self.model.conditional_probability(base, coord, true_action) * self.value_function[true_action]
-            
-            new_value_function[base] = round(max(vals.values()), 3)
+            new_value_function[base] = self.backup(base)
+            if base not in starts :
+                total += self.squared_change(new_value_function[base], self.value_function[base])
 
         new_value_function[(self.grid.end)] = 100
+        self.sweep_residual(total, new_value_function, starts)
         return new_value_function
     
     def value_iter_async(self) :
+        starts = self.tracked_states()
+        total = 0
         for base in self.value_function :
             if base == self.grid.end :
                 continue
-
-            coords = self.grid[base].neighbors.values()
-            vals = {action : self.grid[base].get_reward() for action in coords} 
-
-            for coord in coords :
-                for true_action in self.model.transitions[(base, tuple(coord))].keys() :
-                    vals[true_action] += self.model.conditional_probability(base, coord, true_action) * self.value_function[true_action]
-            
-            self.value_function[base] = round(max(vals.values()), 3)
+            value = self.backup(base)
+            if base not in starts :
+                total += self.squared_change(value, self.value_function[base])
+            self.value_function[base] = value
         self.value_function[(self.grid.end)] = 100
+        return self.sweep_residual(total, self.value_function, starts)
+
+    def index_predecessors(self) :
+        """Indexes the states that can move into each state"""
+        states, _, successors, _ = self.model.transition_arrays()
+        self.predecessors = {}
+        for state, successor in set(zip(states.tolist(), successors.tolist())) :
+            state = self.model.coordinates(state)
+            if state in self.value_function and state != self.grid.end :
+                self.predecessors.setdefault(self.model.coordinates(successor), []).append(state)
+
+    def build_predecessors(self) :
+        """Indexes the states that can move into each state, and seeds the priority queue
+
+        States that cannot reach the End at all would only drift towards minus infinity,
+        so they are set to minus infinity once and never queued.
+        """
+        self.index_predecessors()
+
+        reachable = {self.grid.end}
+        frontier = [self.grid.end]
+        while frontier :
+            for predecessor in self.predecessors.get(frontier.pop(), []) :
+                if predecessor not in reachable :
+                    reachable.add(predecessor)
+                    frontier.append(predecessor)
+
+        self.starts[self.grid.end] = self.value_function[self.grid.end]
+        self.value_function[self.grid.end] = 100
+        self.queue, self.priorities = [], {}
+        for base in self.value_function :
+            if base == self.grid.end :
+                continue
+            if base not in reachable :
+                self.starts[base] = self.value_function[base]
+                self.value_function[base] = -math.inf
+                continue
+            self.push(base)
+
+    def push(self, base) :
+        error = abs(self.backup(base) - self.value_function[base])
+        if error > 0 and error > self.priorities.get(base, 0) :
+            self.priorities[base] = error
+            heapq.heappush(self.queue, (-error, base))
+
+    def value_iter_prioritized(self) :
+        """Backs up as many states as one sweep would, largest Bellman error first
+
+        After a state changes only its predecessors are re-examined, so the End reward
+        spreads along the queue instead of one cell per sweep.
+        """
+        # Values at the start of the epoch of every state updated during it
+        self.starts = {}
+        if self.predecessors is None :
+            self.build_predecessors()
+        budget = len(self.value_function) - 1
+        while self.queue and budget > 0 :
+            error, base = heapq.heappop(self.queue)
+            if self.priorities.get(base) != -error :
+                continue
+            del self.priorities[base]
+            self.starts.setdefault(base, self.value_function[base])
+            self.value_function[base] = self.backup(base)
+            budget -= 1
+            for predecessor in self.predecessors.get(base, []) :
+                if self.value_function[predecessor] != -math.inf :
+                    self.push(predecessor)
+        return self.sweep_residual(0, self.value_function, self.starts)
 
     def process(self) :
-        if self.synchronous :
+        return self.timed("backup", self.sweep)
+
+    def sweep(self) :
+        self.refresh_rewards()
+        if self.engine is not None :
+            self.backups += len(self.engine.states)
+            return self.engine.value_sweep(self.synchronous)
+        if self.prioritized :
+            return self.value_iter_prioritized()
+        elif self.synchronous :
             self.value_function = self.value_iter_sync()
+            return self.residual
         else :
-            self.value_iter_async()        
+            return self.value_iter_async()
 
-            
+class ShortestPathSolver(PolicyAlgorithm) :
+    def __init__(self, grid, model, synchronous = False) -> None :
+        """Solves a deterministic model exactly with a single reverse Dijkstra from the End
+
+        With deterministic transitions and rewards the value of a state is 100 plus the rewards
+        collected along the best path to the End, so the optimal value function is a shortest
+        path problem with costs -reward over the same moves as the model, giving the fixed point
+        of Value Iteration. States that cannot reach the End are valued at minus infinity.
+        """
+        super().__init__(grid, model, synchronous)
+        if not self.applicable(model) :
+            raise ValueError("Shortest paths require a deterministic model with non-positive deterministic rewards")
+
+    @staticmethod
+    def applicable(model) :
+        grid = model.grid
+        active = ~np.isin(grid.types, [Obstacle.kind, End.kind])
+        return bool(model.deterministic and np.all(grid.deterministic[active]) and np.all(grid.reward_mean[active] <= 0))
+
+    @staticmethod
+    def distances(grid) :
+        """Returns the least cost -reward of reaching the End from every flat index y * size + x
+
+        A move pays the reward of the cell it leaves. Cells that cannot reach the End, and
+        obstacles, are at infinity.
+        """
+        size = grid.size
+        costs = (-grid.reward_mean.astype(float)).ravel().tolist()
+        masks = grid.neighbor_mask.ravel().tolist()
+        active = (~np.isin(grid.types, [Obstacle.kind, End.kind])).ravel().tolist()
+        steps = [-1, -size, 1, size]
+
+        # Predecessors are the accessible neighbors since adjacency is symmetric
+        distances = [math.inf] * size ** 2
+        end = grid.end[1] * size + grid.end[0]
+        distances[end] = 0
+        heap = [(0.0, end)]
+        while heap :
+            distance, state = heapq.heappop(heap)
+            if distance > distances[state] :
+                continue
+            mask = masks[state]
+            for predecessor in [state + steps[k] for k in range(4) if mask >> k & 1] :
+                if not active[predecessor] :
+                    continue
+                candidate = distance + costs[predecessor]
+                if candidate < distances[predecessor] :
+                    distances[predecessor] = candidate
+                    heapq.heappush(heap, (candidate, predecessor))
+        return distances
+
+    def iterate(self, snapshots = True) :
+        """Solves the whole grid in one step, yielding a single Snapshot"""
+        self.diffs = []
+        buffers = self.snapshot_buffers() if snapshots else None
+        size = self.grid.size
+        distances = self.distances(self.grid)
+        self.value_function = {key : 100 - distances[key[1] * size + key[0]] for key in self.value_function}
+        self.value_function[self.grid.end] = 100
+        self.policy_improvement()
+        yield self.snapshot(0, 0.0, *buffers) if snapshots else None
+        self.converged = True
+        self.emit("converged", epoch=0, residual=0.0, backups=self.backups, message="Solved by shortest paths")
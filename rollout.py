@@ -0,0 +1,190 @@
+import argparse, time
+import numpy as np
+from cell import OFFSETS
+from grid import Grid
+from model import Model
+from policy import PolicyIteration, ValueIteration
+
+class Rollouts :
+    def __init__(self, returns, steps, finished) :
+        """The outcome of a batch of episodes
+
+        Args:
+            returns (numpy.ndarray): The total reward of every episode, End reward included
+            steps (numpy.ndarray): The number of moves of every episode
+            finished (numpy.ndarray): Whether every episode reached the End before the step limit
+        """
+        self.returns = returns
+        self.steps = steps
+        self.finished = finished
+
+    def summary(self) :
+        """Returns the success rate and the distribution of the returns and steps of finished episodes"""
+        returns, steps = self.returns[self.finished], self.steps[self.finished]
+        result = {"episodes" : len(self.returns), "success_rate" : float(np.mean(self.finished)) if len(self.returns) else 0.0}
+        if len(returns) :
+            result |= {"mean_return" : float(returns.mean()), "std_return" : float(returns.std()),
+                       "return_percentiles" : dict(zip([5, 25, 50, 75, 95], np.percentile(returns, [5, 25, 50, 75, 95]).tolist())),
+                       "mean_steps" : float(steps.mean()), "max_steps" : int(steps.max())}
+        return result
+
+    def histogram(self, bins = 20) :
+        """Returns the counts and bin edges of the returns of finished episodes"""
+        return np.histogram(self.returns[self.finished], bins=bins)
+
+class RolloutSimulator :
+    def __init__(self, model, policy, seed = None, sample_rewards = False) :
+        """Runs many episodes of a policy through a model in lockstep
+
+        Every step leaves a state for its reward, then draws the successor of the action the
+        policy picks from the transition table of the model. Entering a portal moves to the
+        other portal, like the portal value swap of policy evaluation, and entering the End
+        collects 100 and finishes the episode.
+
+        Args:
+            model (Model): The model of the environment to simulate
+            policy (dict): A policy dict mapping states to the probability of each neighbor,
+                the most likely neighbor is followed
+            seed (int, optional): The seed of the generator drawing the transitions. Defaults to None.
+            sample_rewards (boolean, optional): Whether the rewards of stochastic cells are drawn
+                from their normal distribution instead of taking their mean. Defaults to False.
+        """
+        self.model = model
+        self.grid = model.grid
+        self.size = self.grid.size
+        self.rng = np.random.default_rng(seed)
+        self.sample_rewards = sample_rewards
+        cells = self.size ** 2
+        self.end = self.grid.end[1] * self.size + self.grid.end[0]
+
+        self.means = np.nan_to_num(self.grid.reward_mean.ravel().astype(float))
+        self.stds = np.where(self.grid.deterministic.ravel(), 0, self.grid.reward_std.ravel().astype(float))
+        self.teleport = np.arange(cells)
+        for (x, y), (i, j) in self.grid.portals.items() :
+            self.teleport[y * self.size + x] = j * self.size + i
+
+        # The chosen direction slot of every state, -1 where the policy has no action
+        slots = np.full(cells, -1, dtype=np.int8)
+        for (x, y), probabilities in policy.items() :
+            if probabilities and max(probabilities.values()) > 0 :
+                i, j = max(probabilities, key=probabilities.get)
+                slots[y * self.size + x] = OFFSETS.index((i - x, j - y))
+
+        # Up to four outcomes per state for its chosen action, as successors and a cumulative distribution
+        states, actions, successors, probabilities = self.model.transition_arrays()
+        keep = slots[states] == actions
+        states, successors, probabilities = states[keep].astype(np.int64), successors[keep], probabilities[keep]
+        first = np.searchsorted(states, states)
+        rank = np.arange(len(states)) - first
+        cumulative = np.cumsum(probabilities)
+        cumulative -= (cumulative - probabilities)[first]
+        self.counts = np.bincount(states, minlength=cells)
+        self.successors = np.repeat(np.arange(cells)[:, None], 4, axis=1)
+        self.successors[states, rank] = successors
+        self.cdf = np.full((cells, 4), np.inf)
+        self.cdf[states, rank] = cumulative
+        self.movable = self.counts > 0
+
+    def step(self, positions) :
+        """Returns the successors drawn for a batch of flat positions"""
+        u = self.rng.random(len(positions))
+        outcome = np.minimum((u[:, None] >= self.cdf[positions]).sum(axis=1), np.maximum(self.counts[positions] - 1, 0))
+        return self.teleport[self.successors[positions, outcome]]
+
+    def rewards(self, positions) :
+        if not self.sample_rewards :
+            return self.means[positions]
+        return self.rng.normal(self.means[positions], self.stds[positions])
+
+    def simulate(self, episodes, starts = None, max_steps = None) :
+        """Runs a batch of episodes until each one reaches the End or the step limit
+
+        Args:
+            episodes (int): The number of episodes
+            starts (optional): A start state tuple, or an array of flat start indices, one per
+                episode. Defaults to the Start of the grid.
+            max_steps (int, optional): The step limit of an episode. Defaults to 10 * size ** 2.
+
+        Returns:
+            Rollouts: The returns, step counts and finished flags of the episodes
+        """
+        if starts is None :
+            starts = self.grid.start
+        if isinstance(starts, tuple) :
+            starts = np.full(episodes, starts[1] * self.size + starts[0])
+        max_steps = max_steps if max_steps is not None else 10 * self.size ** 2
+
+        returns = np.zeros(episodes)
+        steps = np.zeros(episodes, dtype=np.int64)
+        finished = np.zeros(episodes, dtype=bool)
+        active = np.arange(episodes)
+        positions = self.teleport[np.asarray(starts, dtype=np.int64)]
+        totals = np.zeros(episodes)
+        for step in range(max_steps) :
+            # Episodes stuck without an action can never finish
+            live = self.movable[positions] & (positions != self.end)
+            if not live.all() :
+                done = positions == self.end
+                finished[active[done]] = True
+                returns[active[done]] = totals[done] + 100
+                steps[active[~live]] = step
+                returns[active[~live & ~done]] = totals[~live & ~done]
+                active, positions, totals = active[live], positions[live], totals[live]
+            if not len(active) :
+                break
+            totals += self.rewards(positions)
+            positions = self.step(positions)
+        else :
+            done = positions == self.end
+            finished[active[done]] = True
+            returns[active] = totals + 100 * done
+            steps[active] = max_steps
+        return Rollouts(returns, steps, finished)
+
+    def evaluate(self, episodes = 100, states = None, max_steps = None) :
+        """Estimates the value of states by the mean return of episodes starting from them
+
+        Args:
+            episodes (int, optional): The number of episodes per state. Defaults to 100.
+            states (list, optional): The states to evaluate. Defaults to every state with an action.
+
+        Returns:
+            dict: The mean return of every state, minus infinity when no episode finished
+        """
+        if states is None :
+            indices = np.flatnonzero(self.movable)
+        else :
+            indices = np.array([y * self.size + x for x, y in states], dtype=np.int64)
+        rollouts = self.simulate(len(indices) * episodes, np.repeat(indices, episodes), max_steps)
+        finished = rollouts.finished.reshape(len(indices), episodes)
+        totals = np.where(finished, rollouts.returns.reshape(len(indices), episodes), 0).sum(axis=1)
+        counts = finished.sum(axis=1)
+        means = np.where(counts > 0, totals / np.maximum(counts, 1), -np.inf)
+        return {(int(i) % self.size, int(i) // self.size) : float(value) for i, value in zip(indices, means)}
+
+def main(argv = None) :
+    parser = argparse.ArgumentParser(description="Simulate episodes of a solved policy and report the distribution of returns")
+    parser.add_argument("--size", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--epsilon", type=float, default=0.4)
+    parser.add_argument("--deterministic", action="store_true")
+    parser.add_argument("--algorithm", choices=["policy", "value"], default="value")
+    parser.add_argument("--episodes", type=int, default=10000)
+    parser.add_argument("--sample-rewards", action="store_true")
+    args = parser.parse_args(argv)
+
+    grid = Grid(args.size, seed=args.seed)
+    model = Model(grid, args.deterministic, args.epsilon, compact=True)
+    p = (PolicyIteration if args.algorithm == "policy" else ValueIteration)(grid, model)
+    p.derive_policy()
+    simulator = RolloutSimulator(model, p.policy, seed=args.seed, sample_rewards=args.sample_rewards)
+    start = time.perf_counter()
+    rollouts = simulator.simulate(args.episodes)
+    elapsed = time.perf_counter() - start
+    for name, value in rollouts.summary().items() :
+        print(f"{name:<20} {value}")
+    print(f"{'steps_per_second':<20} {rollouts.steps.sum() / elapsed:.0f}")
+    print(f"{'planned_value':<20} {p.value_function[grid.start]}")
+
+if __name__ == "__main__" :
+    main()